@@ -11,16 +11,23 @@
     'author': "YelTech",
     'website': "http://www.yeltech.ma",
     'category': 'Uncategorized',
-    'depends': ['account', 'projet_stock_depot', 'mrp', 'hr', 'btp_customisation'],
+    'depends': ['account', 'purchase', 'projet_stock_depot', 'mrp', 'hr', 'btp_customisation'],
+    'external_dependencies': {
+        'python': ['numpy'],
+    },
 
     'data': [
         'security/ir.model.access.csv',
+        'data/ir_cron_data.xml',
         'wizard/project_fiancial_create_view.xml',
         'views/project_financial_axis_line.xml',
         'views/project_financial_axis.xml',
         'views/project_financial_progress.xml',
+        'views/project_financial_data_importer.xml',
+        'views/project_financial_kpi_snapshot.xml',
         'views/project_financial_axis_budget_line.xml',
         'views/res_config_settings_views.xml',
+        'views/mrp_workcenter_views.xml',
         'views/ddff.xml',
     ],
     'application': True,
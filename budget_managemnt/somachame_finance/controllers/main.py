@@ -0,0 +1,28 @@
+from odoo import http
+from odoo.http import request
+
+
+class ProjectFinancialController(http.Controller):
+
+    @http.route('/somachame_finance/scurve', type='http', auth='user', methods=['GET'])
+    def scurve(self, project_id=None, axis_ids=None, **kwargs):
+        """
+        Courbes en S cumulées (VP, VA, CR, IPC, IPD) au format JSON
+        project_id: projet financier, ou axis_ids: axes séparés par des virgules
+        Répond 304 si l'empreinte (ETag) du client est à jour
+        """
+        Kpi = request.env['project.financial.axis.kpi']
+        try:
+            project_id = int(project_id) if project_id else None
+            axis_ids = [int(axis_id) for axis_id in axis_ids.split(',') if axis_id.strip()] if axis_ids else None
+        except ValueError:
+            return request.make_json_response(
+                {'error': "project_id et axis_ids doivent être des identifiants entiers"}, status=400)
+        
+        etag = Kpi.get_scurve_etag(project_id, axis_ids)
+        headers = [('ETag', f'"{etag}"'), ('Cache-Control', 'private, no-cache')]
+        if request.httprequest.headers.get('If-None-Match', '').strip('"') == etag:
+            return request.make_response('', headers=headers, status=304)
+        
+        data = Kpi.get_scurve_data(project_id, axis_ids)
+        return request.make_json_response(data, headers=headers)
@@ -7,4 +7,10 @@ from . import project_project
 from . import standard_pgp
 from . import mrp_production
 from . import product_category_mrp_ratio
-from . import importering
\ No newline at end of file
+from . import importering
+from . import project_financial_sync_queue
+from . import purchase_order
+from . import project_financial_kpi
+from . import project_financial_forecast
+from . import project_financial_kpi_snapshot
+from . import project_financial_index
\ No newline at end of file
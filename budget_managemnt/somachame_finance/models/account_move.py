@@ -13,38 +13,247 @@ class AccountMove(models.Model):
         """
         result = super().action_post()
         
-        # Après validation, synchroniser toutes les lignes
-        for move in self:
-            if move.move_type == 'in_invoice' and move.project_id:
-                for line in move.line_ids:
-                    if line._is_valid_for_axis_sync():
-                        axis =  line._get_financial_axes()
-                        if axis:
-                            line._update_axis_line_total(axis)
-                        else:
-                            line.returning_exception('comptabilisation')
+        # Après validation, recalculer en une fois les cellules (axe, date) touchées
+        keys = self._get_axis_sync_keys()
+        if keys:
+            self._recompute_invoice_axis_cells(keys)
         
         return result
     
+    def _get_axis_sync_keys(self):
+        """Couples (projet, date de facture) des factures fournisseurs à synchroniser"""
+        moves = self.filtered(lambda m: m.move_type == 'in_invoice')
+        return moves.invoice_line_ids._get_axis_sync_keys()
+    
+    @api.model
+    def _register_dirty_invoice_keys(self, keys):
+        """
+        Enregistre des couples (projet, date) à recalculer
+        Recalcul groupé une fois par transaction (precommit), ou par la file
+        différée si le contexte 'axis_sync_deferred' est positionné
+        """
+        if not keys:
+            return
+        if self.env.context.get('axis_sync_deferred'):
+            self.env['project.financial.sync.queue']._enqueue('invoice', keys)
+            return
+        
+        dirty = self.env.cr.precommit.data.setdefault('somachame_finance.invoice_keys', set())
+        if not dirty:
+            self.env.cr.precommit.add(self._flush_dirty_invoice_keys)
+        dirty.update(keys)
+    
+    @api.model
+    def _flush_dirty_invoice_keys(self):
+        keys = self.env.cr.precommit.data.pop('somachame_finance.invoice_keys', set())
+        if keys:
+            self._recompute_invoice_axis_cells(keys)
+            self.env.flush_all()
+    
+    @api.model
+    def _read_invoice_axis_costs(self, project_ids, dates=None, move_ids=None):
+        """
+        Agrège le coût des lignes de factures fournisseurs comptabilisées
+        par (axe, date), la catégorie produit étant rattachée à l'axe par parent_path
+        Une ligne avec distribution analytique est répartie entre les projets
+        dont le compte analytique y figure (montant TTC x pourcentage) ; une clé
+        combinée "a,b" est imputée une seule fois, au premier compte rattaché
+        à un projet. Une ligne dont aucune clé ne désigne un projet reste
+        imputée, au montant TTC, au projet de la facture
+        Les montants sont sommés par devise de facture puis convertis en masse
+        dans la devise de l'axe
+        move_ids: limite l'agrégation à ces factures
+        Retourne {(axis_id, date): total}
+        """
+        if not project_ids:
+            return {}
+        
+        self.env.flush_all()
+        account_ids = self.env['project.financial.progress'].search([
+            ('project_id', 'in', list(project_ids)),
+        ]).account_id.ids
+        
+        # Le filtre sur les clés de distribution reprend l'expression
+        # de l'index GIN (voir AccountMoveLine.init)
+        query = """
+            WITH dist AS (
+                SELECT DISTINCT ON (aml.id, dist.key)
+                       aml.id AS line_id,
+                       pfp.project_id,
+                       ABS(aml.price_total) * dist.value::numeric / 100 AS amount
+                FROM account_move_line aml
+                CROSS JOIN LATERAL jsonb_each_text(aml.analytic_distribution) dist
+                CROSS JOIN LATERAL unnest(string_to_array(dist.key, ',')) WITH ORDINALITY AS acc(account_id, position)
+                JOIN project_financial_progress pfp ON pfp.account_id::text = acc.account_id
+                WHERE regexp_split_to_array(
+                          jsonb_path_query_array(aml.analytic_distribution, '$.keyvalue()."key"')::text,
+                          '\\D+'
+                      ) && %s::text[]
+                ORDER BY aml.id, dist.key, acc.position, pfp.id
+            ),
+            src AS (
+                SELECT line_id, project_id, amount
+                FROM dist
+                WHERE project_id IN %s
+                UNION ALL
+                SELECT aml.id, am.project_id, ABS(aml.price_total)
+                FROM account_move_line aml
+                JOIN account_move am ON am.id = aml.move_id
+                WHERE am.project_id IN %s
+                  AND NOT EXISTS (
+                      SELECT 1
+                      FROM jsonb_object_keys(COALESCE(aml.analytic_distribution, '{}'::jsonb)) key
+                      JOIN project_financial_progress pfp
+                        ON pfp.account_id::text = ANY(string_to_array(key, ','))
+                  )
+            )
+            SELECT axis.id,
+                   COALESCE(am.invoice_date, am.date),
+                   am.currency_id,
+                   axis.currency_id,
+                   am.company_id,
+                   SUM(src.amount)
+            FROM src
+            JOIN account_move_line aml ON aml.id = src.line_id
+            JOIN account_move am ON am.id = aml.move_id
+            JOIN product_product pp ON pp.id = aml.product_id
+            JOIN product_template pt ON pt.id = pp.product_tmpl_id
+            JOIN product_category pc ON pc.id = pt.categ_id
+            JOIN project_financial_progress pfp ON pfp.project_id = src.project_id
+            JOIN project_financial_axis axis ON axis.project_financial_id = pfp.id
+            WHERE am.move_type = 'in_invoice'
+              AND am.state = 'posted'
+              AND aml.display_type = 'product'
+              AND axis.cost_type = 'invoice'
+              AND axis.active
+              AND EXISTS (
+                  SELECT 1
+                  FROM product_category_project_financial_axis_rel rel
+                  JOIN product_category ac ON ac.id = rel.product_category_id
+                  WHERE rel.project_financial_axis_id = axis.id
+                    AND pc.parent_path LIKE ac.parent_path || '%%'
+              )
+        """
+        params = [[str(account_id) for account_id in account_ids], tuple(project_ids), tuple(project_ids)]
+        if dates:
+            query += " AND COALESCE(am.invoice_date, am.date) IN %s"
+            params.append(tuple(dates))
+        if move_ids:
+            query += " AND am.id IN %s"
+            params.append(tuple(move_ids))
+        query += " GROUP BY axis.id, COALESCE(am.invoice_date, am.date), am.currency_id, axis.currency_id, am.company_id"
+        
+        self.env.cr.execute(query, params)
+        totals = defaultdict(float)
+        rates = {}
+        for axis_id, date, currency_id, axis_currency_id, company_id, amount in self.env.cr.fetchall():
+            rate = self._get_axis_conversion_rate(currency_id, axis_currency_id, company_id, date, rates)
+            totals[(axis_id, date)] += float(amount) * rate
+        return totals
+    
+    @api.model
+    def _get_axis_conversion_rate(self, from_currency_id, to_currency_id, company_id, date, cache):
+        """Taux de conversion mis en cache par (devise, devise axe, société, date)"""
+        if not to_currency_id or from_currency_id == to_currency_id:
+            return 1.0
+        key = (from_currency_id, to_currency_id, company_id, date)
+        if key not in cache:
+            Currency = self.env['res.currency']
+            cache[key] = Currency._get_conversion_rate(
+                Currency.browse(from_currency_id),
+                Currency.browse(to_currency_id),
+                self.env['res.company'].browse(company_id),
+                date,
+            )
+        return cache[key]
+    
+    @api.model
+    def _revalue_invoice_costs(self, currency, company, date_from, date_to=None):
+        """
+        Réévalue le coût facture des axes après correction d'un taux
+        Le taux intervient dans toute conversion depuis ou vers cette devise :
+        sont recalculées les cellules des factures dans cette devise et celles
+        des axes tenus dans cette devise, sur la période
+        """
+        domain = [
+            ('move_type', '=', 'in_invoice'),
+            ('state', '=', 'posted'),
+            ('currency_id', '=', currency.id),
+            ('invoice_date', '>=', date_from),
+        ]
+        if company:
+            domain.append(('company_id', '=', company.id))
+        if date_to:
+            domain.append(('invoice_date', '<', date_to))
+        
+        moves = self.search(domain)
+        keys = moves._get_axis_sync_keys()
+        
+        self.env.flush_all()
+        query = """
+            SELECT DISTINCT pfp.project_id, line.date
+            FROM project_financial_axis_line line
+            JOIN project_financial_axis axis ON axis.id = line.axis_id
+            JOIN project_financial_progress pfp ON pfp.id = axis.project_financial_id
+            JOIN project_project pp ON pp.id = pfp.project_id
+            WHERE axis.currency_id = %s
+              AND axis.cost_type = 'invoice'
+              AND line.date >= %s
+        """
+        params = [currency.id, date_from]
+        if company:
+            query += " AND pp.company_id = %s"
+            params.append(company.id)
+        if date_to:
+            query += " AND line.date < %s"
+            params.append(date_to)
+        self.env.cr.execute(query, params)
+        axis_keys = set(self.env.cr.fetchall())
+        
+        _logger.info(
+            f"Réévaluation {currency.name} depuis {date_from}: {len(moves)} factures, "
+            f"{len(keys)} cellules facture, {len(axis_keys)} cellules d'axes en {currency.name}"
+        )
+        self._register_dirty_invoice_keys(keys | axis_keys)
+    
+    @api.model
+    def _recompute_invoice_axis_cells(self, keys):
+        """
+        Recalcule le coût facture des cellules (axe, date) des couples (projet, date)
+        Une requête d'agrégation par projet, puis un seul upsert
+        """
+        dates_by_project = defaultdict(set)
+        for project_id, date in keys:
+            dates_by_project[project_id].add(date)
+        
+        cells = {}
+        AxisLine = self.env['project.financial.axis.line']
+        for project_id, dates in dates_by_project.items():
+            totals = self._read_invoice_axis_costs([project_id], dates)
+            cells.update({key: {'actual_cost': total} for key, total in totals.items()})
+            
+            # Les cellules existantes sans facture correspondante reviennent à 0
+            for line in AxisLine.search([
+                ('project_financial_id.project_id', '=', project_id),
+                ('axis_id.cost_type', '=', 'invoice'),
+                ('date', 'in', list(dates)),
+            ]):
+                cells.setdefault((line.axis_id.id, line.date), {'actual_cost': 0.0})
+        
+        _logger.info(f"Factures: {len(cells)} cellules recalculées pour {len(dates_by_project)} projet(s)")
+        return AxisLine._upsert_cells(cells, ['actual_cost'])
+    
     def button_draft(self):
         """
         Surcharge de l'action de remise à brouillon
         """
-        # Avant remise à brouillon, nettoyer les axes pour les factures validées
-        for move in self:
-            if move.move_type == 'in_invoice' and move.project_id and move.state == 'posted':
-                _logger.info(f"Facture {move.id}: Passage à brouillon -> NETTOYAGE")
-                for line in move.line_ids:
-                    if line._is_valid_for_axis_sync():
-                        axis = line._get_financial_axes()
-                        if axis:
-                            line._cleanup_old_axis(
-                                axis, 
-                                move.invoice_date or line.date,
-                                abs(line.price_total)
-                            )
-                        else:
-                            line.returning_exception('met en brouillans')
+        # Avant remise à brouillon, retirer en une fois le coût des factures validées
+        moves = self.filtered(lambda m: m.move_type == 'in_invoice' and m.state == 'posted')
+        project_ids = {project_id for project_id, date in moves._get_axis_sync_keys()}
+        if project_ids:
+            _logger.info(f"Factures {moves.ids}: Passage à brouillon -> NETTOYAGE")
+            cells = self._read_invoice_axis_costs(project_ids, move_ids=moves.ids)
+            self.env['project.financial.axis.line']._subtract_cells(cells, 'actual_cost')
         
         result = super().button_draft()
         return result
@@ -135,76 +344,21 @@ class AccountMove(models.Model):
             return False
         
         _logger.info(f"Synchronisation facture {self.name} avec axes")
-        
-        # Regrouper les totaux par axe et par date
-        axis_totals = defaultdict(lambda: defaultdict(float))
-        
-        # Date de la facture
-        invoice_date = self.invoice_date or self.date
-        date_str = invoice_date.strftime('%Y-%m-%d') if invoice_date else fields.Date.today().strftime('%Y-%m-%d')
-        
-        # Parcourir les lignes de la facture
-        for line in self.line_ids:
-            if not line._is_valid_for_axis_sync():
-                continue
-            
-            axes = line._get_financial_axes()
-            for axis in axes:
-                axis_totals[axis.id][date_str] += abs(line.price_total)
-        
-        # Mettre à jour les lignes d'axe
-        AxisLine = self.env['project.financial.axis.line']
-        
-        for axis_id, date_values in axis_totals.items():
-            axis = self.env['project.financial.axis'].browse(axis_id)
-            
-            for date_str, total in date_values.items():
-                # Calculer le nouveau total pour cet axe et cette date
-                lines_same_date = self.env['account.move.line'].search([
-                    ('move_id.move_type', '=', 'in_invoice'),
-                    ('parent_state', '=', 'posted'),
-                    ('move_id.project_id', '=', self.project_id.id),
-                    '|',
-                    ('invoice_date', '=', invoice_date),
-                    ('date', '=', invoice_date),
-                    ('display_type', '=', 'product'),
-                ])
-                
-                total_for_date = 0.0
-                for l in lines_same_date:
-                    if l._matches_axis(axis):
-                        total_for_date += abs(l.price_total)
-                
-                # Mettre à jour la ligne d'axe
-                axis_line = AxisLine.search([
-                    ('axis_id', '=', axis_id),
-                    ('date', '=', date_str),
-                ], limit=1)
-                
-                if axis_line:
-                    axis_line.write({'actual_cost': total_for_date})
-                    _logger.info(f"Axe {axis.name}: coût mis à jour {total_for_date}")
-                elif total_for_date > 0:
-                    AxisLine.create({
-                        'axis_id': axis_id,
-                        'date': date_str,
-                        'actual_cost': total_for_date,
-                    })
-                    _logger.info(f"Axe {axis.name}: nouvelle ligne {total_for_date}")
-        
+        self._recompute_invoice_axis_cells(self._get_axis_sync_keys())
         return True
     
     def _sync_all_project_invoices(self, cleanup=False):
         """
         Synchronise TOUTES les factures du projet avec les axes financiers
-        Version optimisée avec regroupement
+        Les totaux (axe, date) sont agrégés en SQL puis appliqués en un upsert :
+        seul le coût facture est remplacé, les autres valeurs des lignes
+        (valeur acquise, lignes par défaut) sont conservées
         """
         if not self.project_id:
             return False
         
         _logger.info(f"Synchronisation complète factures projet {self.project_id.name}")
         
-        # Récupérer le projet financier
         financial_progress = self.env['project.financial.progress'].search([
             ('project_id', '=', self.project_id.id)
         ], limit=1)
@@ -213,67 +367,78 @@ class AccountMove(models.Model):
             _logger.warning(f"Aucun projet financier trouvé pour le projet {self.project_id.name}")
             return False
         
-        # Récupérer tous les axes de type invoice
-        invoice_axes = financial_progress.axis_ids.filtered(
-            lambda a: a.cost_type == 'invoice'
-        )
+        totals = self._read_invoice_axis_costs([self.project_id.id])
+        cells = {key: {'actual_cost': total} for key, total in totals.items()}
         
-        # Récupérer toutes les factures
-        all_invoices = self.env['account.move'].search([
-            ('move_type', '=', 'in_invoice'),
-            ('state', '=', 'posted'),
-            ('project_id', '=', self.project_id.id)
-        ])
-        
-        # Regrouper les totaux par axe et par date
-        axis_totals = defaultdict(lambda: defaultdict(float))
-        
-        # Phase 1: Calculer les totaux
-        for invoice in all_invoices:
-            invoice_date = invoice.invoice_date or invoice.date
-            date_str = invoice_date.strftime('%Y-%m-%d') if invoice_date else fields.Date.today().strftime('%Y-%m-%d')
-            
-            for line in invoice.line_ids:
-                if not line._is_valid_for_axis_sync():
-                    continue
-                
-                for axis in invoice_axes:
-                    if line._matches_axis(axis):
-                        axis_totals[axis.id][date_str] += abs(line.price_total)
-        
-        # Phase 2: Mettre à jour les lignes d'axe
+        # Les lignes dont le coût ne provient plus d'aucune facture reviennent à 0
         AxisLine = self.env['project.financial.axis.line']
+        for line in AxisLine.search([
+            ('project_financial_id', '=', financial_progress.id),
+            ('axis_id.cost_type', '=', 'invoice'),
+            ('actual_cost', '!=', 0),
+        ]):
+            cells.setdefault((line.axis_id.id, line.date), {'actual_cost': 0.0})
         
-        for axis_id, date_values in axis_totals.items():
-            axis = self.env['project.financial.axis'].browse(axis_id)
-            
-            # Supprimer les anciennes lignes pour cet axe
-            if not cleanup:
-                old_lines = AxisLine.search([('axis_id', '=', axis_id)])
-                old_lines.unlink()
-            
-            # Créer les nouvelles lignes
-            for date_str, total in date_values.items():
-                if total > 0:
-                    AxisLine.create({
-                        'axis_id': axis_id,
-                        'date': date_str,
-                        'actual_cost': total,
-                    })
-                    _logger.info(f"Axe {axis.name}: ligne {date_str} = {total}")
-        
-        _logger.info(f"Synchronisation terminée: {len(all_invoices)} factures, {len(invoice_axes)} axes")
+        AxisLine._upsert_cells(cells, ['actual_cost'])
+        
+        _logger.info(f"Synchronisation terminée: {len(totals)} cellules facture pour {financial_progress.name}")
         return True
 
+class ResCurrencyRate(models.Model):
+    _inherit = 'res.currency.rate'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        rates = super().create(vals_list)
+        rates._revalue_axis_invoice_costs()
+        return rates
+
+    def write(self, vals):
+        if 'name' in vals:
+            # L'ancienne période est aussi touchée
+            self._revalue_axis_invoice_costs()
+        result = super().write(vals)
+        if any(field in vals for field in ['rate', 'company_rate', 'inverse_company_rate', 'name']):
+            self._revalue_axis_invoice_costs()
+        return result
+
+    def unlink(self):
+        self._revalue_axis_invoice_costs()
+        return super().unlink()
+
+    def _revalue_axis_invoice_costs(self):
+        """Réévalue les coûts facture couverts par la période de validité du taux"""
+        for rate in self:
+            next_rate = self.search([
+                ('currency_id', '=', rate.currency_id.id),
+                ('company_id', '=', rate.company_id.id),
+                ('name', '>', rate.name),
+            ], order='name asc', limit=1)
+            self.env['account.move']._revalue_invoice_costs(
+                rate.currency_id, rate.company_id, rate.name, next_rate.name or None,
+            )
+
 class AccountMoveLine(models.Model):
     _inherit = 'account.move.line'
 
+    def init(self):
+        super().init()
+        # Index GIN sur les comptes des clés de distribution analytique,
+        # même expression que le filtre de _read_invoice_axis_costs
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_move_line_analytic_distribution_accounts_gin_index
+            ON account_move_line USING gin(regexp_split_to_array(
+                jsonb_path_query_array(analytic_distribution, '$.keyvalue()."key"')::text,
+                '\\D+'
+            ))
+        """)
+
     def _is_valid_for_axis_sync(self):
         """Vérifie si la ligne est valide pour synchronisation"""
         return (
             self.move_id and
             self.move_id.move_type == 'in_invoice' and 
-            self.move_id.project_id and
+            (self.move_id.project_id or self.analytic_distribution) and
             self.display_type == 'product' and
             self.product_id
         )
@@ -362,14 +527,51 @@ class AccountMoveLine(models.Model):
 
     # ===== CRUD METHODS =====
 
+    def _get_axis_sync_keys(self):
+        """
+        Couples (projet, date) des lignes comptabilisées à synchroniser
+        Les projets d'une ligne distribuée sont ceux dont le compte analytique
+        figure dans la distribution (premier compte d'une clé combinée),
+        sinon le projet de la facture
+        """
+        lines = self.filtered(lambda l: l.parent_state == 'posted' and l._is_valid_for_axis_sync())
+        account_ids = {
+            int(account_id)
+            for line in lines
+            for key in (line.analytic_distribution or {})
+            for account_id in key.split(',')
+            if account_id.isdigit()
+        }
+        # Même choix que _read_invoice_axis_costs : un projet par compte (plus petit id)
+        project_by_account = {}
+        if account_ids:
+            for progress in self.env['project.financial.progress'].search([
+                ('account_id', 'in', list(account_ids)),
+            ], order='id'):
+                project_by_account.setdefault(progress.account_id.id, progress.project_id.id)
+        
+        keys = set()
+        for line in lines:
+            date = line.invoice_date or line.date
+            line_keys = set()
+            for key in line.analytic_distribution or {}:
+                # Une clé combinée est imputée au premier compte rattaché à un projet
+                project_id = next((
+                    project_by_account[int(account_id)] for account_id in key.split(',')
+                    if account_id.isdigit() and int(account_id) in project_by_account
+                ), None)
+                if project_id:
+                    line_keys.add((project_id, date))
+            if not line_keys and line.move_id.project_id:
+                line_keys.add((line.move_id.project_id.id, date))
+            keys |= line_keys
+        return keys
+
     @api.model_create_multi
     def create(self, vals_list):
-        """Création avec synchronisation"""
+        """Création avec synchronisation différée"""
         lines = super().create(vals_list)
-        for line in lines:
-            if line.parent_state == 'posted' and line._is_valid_for_axis_sync():
-                for axis in line._get_financial_axes():
-                    line._update_axis_line_total(axis)
+        self.env['account.move']._register_dirty_invoice_keys(lines._get_axis_sync_keys())
         return lines
 
     # def write(self, vals):
@@ -408,24 +610,10 @@ class AccountMoveLine(models.Model):
         
 
     def unlink(self):
-        """Suppression avec nettoyage"""
-        to_clean = []
-        for line in self:
-            if line._is_valid_for_axis_sync() and line.parent_state == 'posted':
-                axes = line._get_financial_axes()
-                if axes:
-                    to_clean.append({
-                        'axes': axes,
-                        'date': line.invoice_date or line.date,
-                        'price': line.price_total,
-                    })
-        
+        """Suppression avec nettoyage différé"""
+        keys = self._get_axis_sync_keys()
         result = super().unlink()
-        
-        for data in to_clean:
-            for axis in data['axes']:
-                self._cleanup_old_axis(axis, data['date'], data['price'])
-        
+        self.env['account.move']._register_dirty_invoice_keys(keys)
         return result
     
     def returning_exception(self, type):
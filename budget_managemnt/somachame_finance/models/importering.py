@@ -1,367 +1,492 @@
+import base64
+import copy
+import csv
+import io
+import logging
+import time
+from collections import defaultdict
 from datetime import datetime, date
-import random
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError
+from odoo.tools import float_compare, split_every
+
+try:
+    from openpyxl import load_workbook
+except ImportError:
+    load_workbook = None
+
+_logger = logging.getLogger(__name__)
+
+# Colonnes attendues et leurs intitulés acceptés dans l'en-tête
+IMPORT_COLUMNS = {
+    'project': ('project', 'projet'),
+    'axis': ('axis', 'axe'),
+    'month': ('month', 'mois'),
+    'acquise': ('acquise', 'acquise_value', 'avancement'),
+    'cost': ('cost', 'cout', 'coût', 'actual_cost'),
+    'source': ('source',),
+}
+
+# Nombre maximal d'erreurs détaillées dans le rapport
+REPORT_MAX_ERRORS = 1000
+
+# Tailles des fichiers synthétiques du banc d'essai : depuis l'interface,
+# limitées à BENCHMARK_MAX_SIZE ; les tailles supérieures passent par run_benchmark (shell)
+BENCHMARK_SIZES = (1000, 10000)
+BENCHMARK_FULL_SIZES = (1000, 10000, 100000)
+BENCHMARK_MAX_SIZE = 10000
+
+
+class _BenchmarkRollback(Exception):
+    """Annule l'import du banc d'essai en sortie de savepoint"""
+
 
 class ProjectFinancialDataImporter(models.Model):
     _name = 'project.financial.data.importer'
     _description = 'Importateur des données financières'
-    
-    def import_financial_data(self, project_financial_id, year=2024):
+    _rec_name = 'data_filename'
+    _order = 'id desc'
+
+    project_financial_id = fields.Many2one('project.financial.progress', string="Projet Financier",
+                                           help="Projet des lignes dont la colonne projet est vide")
+    data_file = fields.Binary(string="Fichier",
+                              help="CSV ou XLSX : project, axis, month, acquise, cost, source")
+    data_filename = fields.Char(string="Nom du fichier")
+    chunk_size = fields.Integer(string="Taille des lots", default=1000)
+    dry_run = fields.Boolean(string="Simulation",
+                             help="Valide le fichier et compte les cellules à créer, modifier ou ignorer sans rien écrire")
+    imported_count = fields.Integer(string="Lignes importées", readonly=True)
+    cell_count = fields.Integer(string="Cellules écrites", readonly=True)
+    error_count = fields.Integer(string="Lignes en erreur", readonly=True)
+    report = fields.Text(string="Rapport", readonly=True)
+
+    def action_import(self):
+        """Importe le fichier et enregistre le rapport"""
+        self.ensure_one()
+        stats = self.import_financial_data()
+        self.write({
+            'imported_count': stats['rows'],
+            'cell_count': stats['cells'],
+            'error_count': len(stats['errors']),
+            'report': self._format_report(stats),
+        })
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'current',
+        }
+
+    def import_financial_data(self):
         """
-        Importe TOUTES les données financières : acquise_value et coûts réels
+        Importe l'avancement (acquise) et les coûts réels du fichier
+        Les lignes sont lues en flux et écrites par lots en un upsert,
+        à la date du premier jour du mois
+        Retourne les statistiques de l'import
         """
-        # 1. DONNÉES DES ACQUISE_VALUE (pourcentages d'avancement)
-        acquise_data = [
-            {
-                'axis_name': "Études d'execution",
-                'monthly_acquise': {'Jan': 0.40, 'Mar': 0.55}
-            },
-            {
-                'axis_name': 'Méthodes et préparation',
-                'monthly_acquise': {'Fev': 0.10, 'Mar': 0.10, 'Avr': 0.25, 'Mai': 0.25, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Toles et profilés',
-                'monthly_acquise': {'Mar': 0.10, 'Jun': 0.33, 'Mai': 0.10, 'Jui': 0.20}
-            },
-            {
-                'axis_name': 'Tole striee',
-                'monthly_acquise': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'goujon',
-                'monthly_acquise': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00}
-            },
-            {
-                'axis_name': 'Boulonnerie et Accessoires',
-                'monthly_acquise': {'Fev': 0.10, 'Mar': 0.30, 'Avr': 0.30, 'Mai': 0.25, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Couverture et Bardage',
-                'monthly_acquise': {'Fev': 0.00, 'Mar': 0.10, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Caillebotis',
-                'monthly_acquise': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Marche caillebotis',
-                'monthly_acquise': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Convoyeur cover',
-                'monthly_acquise': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00}
-            },
-            {
-                'axis_name': 'Translucide',
-                'monthly_acquise': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00}
-            },
-            {
-                'axis_name': 'Garde corps',
-                'monthly_acquise': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Autres…',
-                'monthly_acquise': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00}
-            },
-            {
-                'axis_name': 'MO Fab',
-                'monthly_acquise': {'Fev': 0.10, 'Mar': 0.15, 'Avr': 0.20}
-            },
-            {
-                'axis_name': 'MO Peinture',
-                'monthly_acquise': {'Fev': 0.10, 'Mar': 0.15, 'Avr': 0.20}
-            },
-            {
-                'axis_name': 'MO Pose',
-                'monthly_acquise': {'Mar': 0.10, 'Mai': 0.15, 'Jui': 0.15}
-            },
-            {
-                'axis_name': 'Transport et Manutention',
-                'monthly_acquise': {'Mar': 0.10, 'Mai': 0.20, 'Jui': 0.20}
-            },
-            {
-                'axis_name': 'Bureau de contrôle',
-                'monthly_acquise': {'Mai': 0.50}
-            },
-        ]
-        
-        # 2. DONNÉES DES COÛTS RÉELS
-        actual_cost_data = [
-            {
-                'axis_name': 'Méthodes et préparation',
-                'cost_type': 'timesheet',
-                'monthly_costs': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Toles et profilés',
-                'cost_type': 'stock',
-                'monthly_costs': {
-                    'Fev': 5715814.95, 'Mar': 4348466.66, 'Avr': 860675.80,
-                    'Mai': 179990.40, 'Jui': 321584.20, 'Juil': 5097.89
-                }
-            },
-            {
-                'axis_name': 'Tole striee',
-                'cost_type': 'stock',
-                'monthly_costs': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'goujon',
-                'cost_type': 'stock',
-                'monthly_costs': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Boulonnerie et Accessoires',
-                'cost_type': 'invoice',
-                'monthly_costs': {
-                    'Fev': 146576.60, 'Mar': 111118.80, 'Avr': 9735.55,
-                    'Mai': 25722.25, 'Jui': 0.00
-                }
-            },
-            {
-                'axis_name': 'Couverture et Bardage',
-                'cost_type': 'stock',
-                'monthly_costs': {
-                    'Fev': 273734.00, 'Mar': 0.00, 'Avr': 270206.00,
-                    'Mai': 3528.00, 'Jui': 0.00
-                }
-            },
-            {
-                'axis_name': 'Caillebotis',
-                'cost_type': 'invoice',
-                'monthly_costs': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Marche caillebotis',
-                'cost_type': 'invoice',
-                'monthly_costs': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Convoyeur cover',
-                'cost_type': 'invoice',
-                'monthly_costs': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Translucide',
-                'cost_type': 'invoice',
-                'monthly_costs': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Garde corps',
-                'cost_type': 'stock',
-                'monthly_costs': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Autres…',
-                'cost_type': 'invoice',
-                'monthly_costs': {
-                    'Fev': 13400.00, 'Mar': 170.00, 'Avr': 0.00,
-                    'Mai': 0.00, 'Jui': 13230.00
-                }
-            },
-            {
-                'axis_name': 'MO Fab',
-                'cost_type': 'timesheet',
-                'monthly_costs': {
-                    'Fev': 159660.00, 'Mar': 22020.00, 'Avr': 85980.00,
-                    'Mai': 51660.00, 'Jui': 0.00
-                }
-            },
-            {
-                'axis_name': 'MO Peinture',
-                'cost_type': 'timesheet',
-                'monthly_costs': {
-                    'Fev': 25740.00, 'Mar': 0.00, 'Avr': 22020.00,
-                    'Mai': 3720.00, 'Jui': 0.00
-                }
-            },
-            {
-                'axis_name': 'Autres',
-                'cost_type': 'invoice',
-                'monthly_costs': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'MO Pose',
-                'cost_type': 'timesheet',
-                'monthly_costs': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 32970.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Transport et Manutention',
-                'cost_type': 'invoice',
-                'monthly_costs': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 27100.00, 'Mai': 24000.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Bureau de contrôle',
-                'cost_type': 'invoice',
-                'monthly_costs': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 4000.00, 'Jui': 0.00}
-            },
-            {
-                'axis_name': 'Autres Sous traitance',
-                'cost_type': 'invoice',
-                'monthly_costs': {'Fev': 0.00, 'Mar': 0.00, 'Avr': 0.00, 'Mai': 0.00, 'Jui': 0.00}
-            },
-        ]
-        
-        # Mapping des mois
-        month_mapping = {
-            'Fev': 2, 'Mar': 3, 'Avr': 4, 'Mai': 5, 'Jui': 6,
-            'Juil': 7, 'Août': 8, 'Sept': 9, 'Oct': 10, 'Nov': 11, 'Déc': 12
-        }
-        
-        # Vérifier que le projet existe
-        project = self.env['project.financial.progress'].browse(project_financial_id)
-        if not project.exists():
-            raise UserError(_("Projet financier non trouvé"))
-        
-        # Récupérer tous les axes du projet
-        axes = self.env['project.financial.axis'].search([
-            ('project_financial_id', '=', project_financial_id)
-        ])
-        
-        if not axes:
-            raise UserError(_("Aucun axe trouvé pour ce projet. Importez d'abord les axes budgétaires."))
-        
-        # Créer un mapping nom_axe → objet_axe
-        axis_dict = {axis.name: axis for axis in axes}
-        
-        acquise_lines_created = []
-        cost_lines_created = []
-        
-        # ==================== IMPORT DES ACQUISE_VALUE ====================
-        print("=== Import des acquise_value ===")
-        for data in acquise_data:
-            axis_name = data['axis_name']
-            axis = axis_dict.get(axis_name)
-            
-            if not axis:
-                print(f"Axe non trouvé pour acquise_value: {axis_name}")
+        self.ensure_one()
+        stats = self._import_rows(self._iter_rows())
+        if stats['synced']:
+            _logger.warning(
+                f"Import {self.data_filename}: {sum(stats['synced'].values())} valeurs sur des champs synchronisés "
+                f"({len(stats['synced'])} axes/champs), remplacées au prochain recalcul de leur source"
+            )
+        if self.dry_run:
+            _logger.info(
+                f"Simulation {self.data_filename}: {stats['to_create']} à créer, "
+                f"{stats['to_update']} à modifier, {stats['to_skip']} inchangées"
+            )
+            return stats
+
+        # Les cumuls mensuels des cellules écrites sont recalculés avant le commit
+        projects = self.env['project.financial.progress'].browse(stats['project_ids'])
+        projects._compute_financial_metrics()
+
+        _logger.info(
+            f"Import {self.data_filename}: {stats['rows']} lignes, "
+            f"{stats['cells']} cellules, {len(stats['errors'])} erreurs"
+        )
+        return stats
+
+    # ===== LECTURE DU FICHIER =====
+
+    def _iter_rows(self):
+        """Itère sur (numéro de ligne, {colonne: valeur}) sans charger le fichier en lignes"""
+        if not self.data_file:
+            raise UserError(_("Aucun fichier à importer"))
+
+        content = base64.b64decode(self.data_file)
+        if (self.data_filename or '').lower().endswith('.xlsx'):
+            if load_workbook is None:
+                raise UserError(_("La librairie openpyxl est requise pour importer un fichier XLSX"))
+            sheet = load_workbook(io.BytesIO(content), read_only=True, data_only=True).active
+            rows = sheet.iter_rows(values_only=True)
+        else:
+            stream = io.TextIOWrapper(io.BytesIO(content), encoding='utf-8-sig', newline='')
+            sample = stream.readline()
+            stream.seek(0)
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=';,\t')
+            except csv.Error:
+                dialect = csv.excel
+            rows = csv.reader(stream, dialect)
+
+        header = next(rows, None)
+        if not header:
+            raise UserError(_("Le fichier est vide"))
+        columns = self._map_header(header)
+
+        for row_number, values in enumerate(rows, start=2):
+            if not any(value not in (None, '') for value in values):
+                continue
+            yield row_number, {
+                column: values[index] if index < len(values) else None
+                for column, index in columns.items()
+            }
+
+    @api.model
+    def _map_header(self, header):
+        """Retourne {colonne: index} depuis l'en-tête du fichier"""
+        labels = [str(label or '').strip().lower() for label in header]
+        columns = {}
+        for column, aliases in IMPORT_COLUMNS.items():
+            for index, label in enumerate(labels):
+                if label in aliases:
+                    columns[column] = index
+                    break
+
+        missing = [column for column in ('axis', 'month') if column not in columns]
+        if missing:
+            raise UserError(_("Colonnes manquantes dans l'en-tête : %s") % ', '.join(missing))
+        if 'acquise' not in columns and 'cost' not in columns:
+            raise UserError(_("Le fichier doit contenir une colonne acquise ou cost"))
+        return columns
+
+    @api.model
+    def _parse_month(self, value):
+        """Premier jour du mois d'une date, ou d'un texte AAAA-MM, AAAA-MM-JJ, MM/AAAA, JJ/MM/AAAA"""
+        if isinstance(value, datetime):
+            return value.date().replace(day=1)
+        if isinstance(value, date):
+            return value.replace(day=1)
+
+        text = str(value or '').strip()
+        for fmt in ('%Y-%m', '%Y-%m-%d', '%m/%Y', '%d/%m/%Y'):
+            try:
+                return datetime.strptime(text, fmt).date().replace(day=1)
+            except ValueError:
                 continue
-            
-            # Pour chaque mois avec pourcentage
-            for month_name, acquise_value in data['monthly_acquise'].items():
-                if acquise_value > 0:  # Ne créer que si > 0
-                    month_number = month_mapping.get(month_name)
-                    if month_number:
-                        # Générer une date aléatoire dans le mois (entre le 1er et le 28)
-                        random_day = random.randint(1, 28)
-                        line_date = date(year, month_number, random_day)
-                        
-                        # Vérifier si une ligne existe déjà pour ce mois
-                        existing_line = self.env['project.financial.axis.line'].search([
-                            ('axis_id', '=', axis.id),
-                            ('date', '=', line_date)
-                        ], limit=1)
-                        
-                        if existing_line:
-                            # Mettre à jour la ligne existante
-                            existing_line.write({
-                                'acquise_value': acquise_value,
-                                'progress': acquise_value * 100,
-                                'description': f"Avancement {month_name} {year}: {acquise_value*100:.0f}%",
-                            })
-                            acquise_lines_created.append(existing_line.id)
-                        else:
-                            # Créer une nouvelle ligne
-                            line_vals = {
-                                'axis_id': axis.id,
-                                'date': line_date,
-                                'acquise_value': acquise_value,
-                                'progress': acquise_value * 100,
-                                'description': f"Avancement {month_name} {year}: {acquise_value*100:.0f}%",
-                                'actual_cost': 0.0,  # Sera mis à jour après
-                            }
-                            
-                            new_line = self.env['project.financial.axis.line'].create(line_vals)
-                            acquise_lines_created.append(new_line.id)
-        
-        # ==================== IMPORT DES COÛTS RÉELS ====================
-        print("=== Import des coûts réels ===")
-        for data in actual_cost_data:
-            axis_name = data['axis_name']
-            axis = axis_dict.get(axis_name)
-            
-            if not axis:
-                print(f"Axe non trouvé pour coût: {axis_name}")
+        raise ValueError(_("Mois invalide '%s'") % text)
+
+    @api.model
+    def _parse_float(self, value):
+        """Nombre d'une cellule, None si vide"""
+        if value in (None, ''):
+            return None
+        if isinstance(value, (int, float)):
+            return float(value)
+        text = str(value).strip().replace('\u00a0', '').replace(' ', '')
+        if not text:
+            return None
+        if ',' in text and '.' not in text:
+            text = text.replace(',', '.')
+        try:
+            return float(text.replace(',', ''))
+        except ValueError:
+            raise ValueError(_("Nombre invalide '%s'") % value)
+
+    # ===== IMPORT =====
+
+    def _resolve_axis(self, row, projects, axes_by_project):
+        """
+        Retourne (axe, base de la quantité acquise, projet financier, sources) d'une ligne
+        sources: {champ: libellé de la synchronisation qui alimente ce champ de l'axe}
+        Les projets et les axes sont préchargés une fois dans des dictionnaires
+        """
+        if not projects:
+            for progress in self.env['project.financial.progress'].search_read([], ['name', 'project_id']):
+                if progress['project_id']:
+                    projects.setdefault(progress['project_id'][1].strip().lower(), progress['id'])
+                projects[(progress['name'] or '').strip().lower()] = progress['id']
+
+        project_name = str(row.get('project') or '').strip()
+        if project_name:
+            project_id = projects.get(project_name.lower())
+            if not project_id:
+                raise ValueError(_("Projet inconnu '%s'") % project_name)
+        elif self.project_financial_id:
+            project_id = self.project_financial_id.id
+        else:
+            raise ValueError(_("Projet non renseigné"))
+
+        if project_id not in axes_by_project:
+            Axis = self.env['project.financial.axis']
+            type_labels = dict(Axis._fields['type']._description_selection(self.env))
+            cost_labels = dict(Axis._fields['cost_type']._description_selection(self.env))
+            axes_by_project[project_id] = {
+                axis['name'].strip().lower(): (
+                    axis['id'],
+                    axis['mrp_planned_weight'] if axis['type'] == 'rate' else axis['planned_quantity'],
+                    project_id,
+                    # Le coût réel vient toujours d'une synchronisation, l'acquise sauf en saisie manuelle
+                    dict(
+                        [('actual_cost', cost_labels.get(axis['cost_type']))]
+                        + ([('earned_value', type_labels.get(axis['type']))] if axis['type'] != 'manual' else [])
+                    ),
+                )
+                for axis in Axis.search_read(
+                    [('project_financial_id', '=', project_id)],
+                    ['name', 'type', 'cost_type', 'planned_quantity', 'mrp_planned_weight'],
+                )
+            }
+
+        axis_name = str(row.get('axis') or '').strip()
+        axis = axes_by_project[project_id].get(axis_name.lower())
+        if not axis:
+            raise ValueError(_("Axe inconnu '%(axis)s' pour le projet %(project)s") % {
+                'axis': axis_name, 'project': project_name or self.project_financial_id.name,
+            })
+        return axis
+
+    def _import_rows(self, rows):
+        """
+        Importe un flux de lignes par lots
+        Les lignes d'une même cellule (axe, mois) sont cumulées champ par champ :
+        la première écriture d'un champ remplace sa valeur, les suivantes s'y ajoutent
+        """
+        projects = {}
+        axes_by_project = {}
+        written = set()
+        stats = {
+            'rows': 0,
+            'cells': 0,
+            'errors': [],
+            'sources': defaultdict(int),
+            'project_ids': set(),
+            'to_create': 0,
+            'to_update': 0,
+            'to_skip': 0,
+            'synced': defaultdict(int),
+        }
+
+        for chunk in split_every(self.chunk_size or 1000, rows):
+            cells = defaultdict(dict)
+            for row_number, row in chunk:
+                try:
+                    axis_id, base, project_id, sources = self._resolve_axis(row, projects, axes_by_project)
+                    month = self._parse_month(row.get('month'))
+                    acquise = self._parse_float(row.get('acquise'))
+                    cost = self._parse_float(row.get('cost'))
+                    if acquise is None and cost is None:
+                        raise ValueError(_("Aucune valeur acquise ni coût"))
+                except ValueError as e:
+                    stats['errors'].append((row_number, str(e)))
+                    continue
+
+                cell = cells[(axis_id, month)]
+                if acquise is not None:
+                    cell['earned_value'] = cell.get('earned_value', 0.0) + acquise * base
+                if cost is not None:
+                    cell['actual_cost'] = cell.get('actual_cost', 0.0) + cost
+                # Valeurs importées sur un champ synchronisé : remplacées au prochain recalcul de la source
+                for fname, value in (('earned_value', acquise), ('actual_cost', cost)):
+                    if value is not None and sources.get(fname):
+                        stats['synced'][(str(row.get('axis')).strip(), fname, sources[fname])] += 1
+                stats['rows'] += 1
+                stats['sources'][str(row.get('source') or '').strip() or _('(aucune)')] += 1
+                stats['project_ids'].add(project_id)
+
+            stats['cells'] += self._write_cells(cells, written, stats)
+
+        return stats
+
+    def _write_cells(self, cells, written, stats):
+        """
+        Écrit un lot de cellules, un upsert par jeu de champs et par mode
+        written: (axis_id, mois, champ) déjà écrits par le fichier, cumulés
+        En simulation, seules les cellules à créer, modifier ou ignorer sont comptées
+        """
+        # Lot dont toutes les lignes sont en erreur
+        if not cells:
+            return 0
+        if self.dry_run:
+            self._count_cell_changes(cells, written, stats)
+            written.update((*key, fname) for key, vals in cells.items() for fname in vals)
+            return len(cells)
+
+        groups = defaultdict(dict)
+        for key, vals in cells.items():
+            by_mode = defaultdict(dict)
+            for fname, value in vals.items():
+                by_mode['add' if (*key, fname) in written else 'set'][fname] = value
+                written.add((*key, fname))
+            for mode, mode_vals in by_mode.items():
+                groups[(tuple(sorted(mode_vals)), mode)][key] = mode_vals
+
+        AxisLine = self.env['project.financial.axis.line']
+        for (fnames, mode), group in groups.items():
+            AxisLine._upsert_cells(group, list(fnames), mode=mode)
+        return len(cells)
+
+    @api.model
+    def _count_cell_changes(self, cells, written, stats):
+        """Compare un lot de cellules aux lignes existantes, en une requête"""
+        self.env.flush_all()
+        self.env.cr.execute("""
+            SELECT axis_id, date, earned_value, actual_cost
+            FROM project_financial_axis_line
+            WHERE (axis_id, date) IN %s
+        """, [tuple(cells)])
+        existing = {
+            (axis_id, date): {'earned_value': earned_value or 0.0, 'actual_cost': actual_cost or 0.0}
+            for axis_id, date, earned_value, actual_cost in self.env.cr.fetchall()
+        }
+
+        for key, vals in cells.items():
+            seen = {fname for fname in ('earned_value', 'actual_cost') if (*key, fname) in written}
+            if key not in existing and not seen:
+                stats['to_create'] += 1
                 continue
-            
-            cost_type = data['cost_type']
-            
-            # Pour chaque mois avec coût
-            for month_name, cost_amount in data['monthly_costs'].items():
-                if cost_amount > 0:  # Ne créer que si > 0
-                    month_number = month_mapping.get(month_name)
-                    if month_number:
-                        # Générer une date aléatoire dans le mois (différente de celle des acquise_value)
-                        random_day = random.randint(1, 28)
-                        # S'assurer que ce n'est pas le même jour que pour acquise_value
-                        while True:
-                            line_date = date(year, month_number, random_day)
-                            # Vérifier si cette date existe déjà pour cet axe
-                            existing_for_date = self.env['project.financial.axis.line'].search([
-                                ('axis_id', '=', axis.id),
-                                ('date', '=', line_date)
-                            ], limit=1)
-                            if not existing_for_date:
-                                break
-                            random_day = (random_day % 28) + 1
-                        
-                        # Vérifier si une ligne existe déjà pour ce mois
-                        existing_line = self.env['project.financial.axis.line'].search([
-                            ('axis_id', '=', axis.id),
-                            ('date', '=', line_date)
-                        ], limit=1)
-                        
-                        if existing_line:
-                            # Mettre à jour le coût sur la ligne existante
-                            existing_line.write({
-                                'actual_cost': cost_amount,
-                                'description': f"{existing_line.description or ''} | Coût {cost_type} {month_name}: {cost_amount:,.2f} DH"
-                            })
-                            cost_lines_created.append(existing_line.id)
-                        else:
-                            # Créer une nouvelle ligne pour le coût
-                            line_vals = {
-                                'axis_id': axis.id,
-                                'date': line_date,
-                                'actual_cost': cost_amount,
-                                'acquise_value': 0.0,  # Pas d'avancement, seulement coût
-                                'progress': 0.0,
-                                'description': f"Coût {cost_type} {month_name} {year}: {cost_amount:,.2f} DH",
-                            }
-                            
-                            new_line = self.env['project.financial.axis.line'].create(line_vals)
-                            cost_lines_created.append(new_line.id)
-        
-        # ==================== RECALCUL AUTOMATIQUE ====================
-        print("=== Recalcul des indicateurs ===")
-        
-        # Recalculer earned_value à partir de acquise_value
-        if acquise_lines_created:
-            lines_to_recompute = self.env['project.financial.axis.line'].browse(
-                list(set(acquise_lines_created))  # Éviter les doublons
+            current = existing.get(key, {})
+            # Un champ déjà écrit par le fichier est cumulé, les autres sont remplacés
+            changed = any(
+                value if fname in seen
+                else float_compare(value, current.get(fname, 0.0), precision_digits=6)
+                for fname, value in vals.items()
             )
-            for line in lines_to_recompute:
-                if line.acquise_value > 0 and line.axis_planned_quantity:
-                    line.earned_value = line.acquise_value * line.axis_planned_quantity
-        
-        # Recalculer les indicateurs du projet
-        project._compute_financial_metrics()
-        
-        # Mettre à jour les cumuls mensuels si existent
-        if hasattr(self.env['project.financial.progress'], '_trigger_cumulative_recomputation'):
-            project._trigger_cumulative_recomputation()
-        
+            stats['to_update' if changed else 'to_skip'] += 1
+
+    def _format_report(self, stats):
+        """Rapport texte de l'import : totaux, répartition par source, erreurs par ligne"""
+        lines = [
+            _("Lignes importées : %s") % stats['rows'],
+            _("Cellules écrites : %s") % stats['cells'],
+            _("Lignes en erreur : %s") % len(stats['errors']),
+        ]
+        if self.dry_run:
+            lines[1] = _("Cellules (simulation) : %(create)s à créer, %(update)s à modifier, %(skip)s inchangées") % {
+                'create': stats['to_create'], 'update': stats['to_update'], 'skip': stats['to_skip'],
+            }
+        if stats['sources']:
+            lines.append('')
+            lines += [f"{source} : {count}" for source, count in sorted(stats['sources'].items())]
+        if stats['synced']:
+            field_labels = {'earned_value': _("valeur acquise"), 'actual_cost': _("coût réel")}
+            lines.append('')
+            lines.append(_("Valeurs remplacées au prochain recalcul de leur source (facture, production, stock...) :"))
+            lines += [
+                _("%(axis)s, %(field)s alimenté par « %(source)s » : %(count)s lignes") % {
+                    'axis': axis, 'field': field_labels[fname], 'source': source, 'count': count,
+                }
+                for (axis, fname, source), count in sorted(stats['synced'].items())
+            ]
+        if stats['errors']:
+            lines.append('')
+            lines += [_("Ligne %(row)s : %(error)s") % {'row': row, 'error': error}
+                      for row, error in stats['errors'][:REPORT_MAX_ERRORS]]
+            if len(stats['errors']) > REPORT_MAX_ERRORS:
+                lines.append(_("... et %s autres erreurs") % (len(stats['errors']) - REPORT_MAX_ERRORS))
+        return '\n'.join(lines)
+
+    # ===== BANC D'ESSAI =====
+
+    def action_benchmark(self):
+        """
+        Mesure le débit de l'import sur des fichiers synthétiques
+        Chaque import est annulé (savepoint) : la base n'est pas modifiée
+        """
+        self.ensure_one()
+        sizes = self.env.context.get('benchmark_sizes') or BENCHMARK_SIZES
+        if max(sizes) > BENCHMARK_MAX_SIZE:
+            raise UserError(_("Au-delà de %s lignes, lancez le banc d'essai depuis le shell (run_benchmark)")
+                            % BENCHMARK_MAX_SIZE)
+        self.run_benchmark(sizes)
         return {
-            'message': _(
-                "Import terminé avec succès!\n"
-                "• Lignes d'avancement créées/mises à jour: %(acquise_count)d\n"
-                "• Lignes de coût créées/mises à jour: %(cost_count)d"
-            ) % {
-                'acquise_count': len(set(acquise_lines_created)),
-                'cost_count': len(set(cost_lines_created))
-            },
-            'acquise_line_ids': list(set(acquise_lines_created)),
-            'cost_line_ids': list(set(cost_lines_created)),
-        }
\ No newline at end of file
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'current',
+        }
+
+    def run_benchmark(self, sizes=BENCHMARK_FULL_SIZES):
+        """
+        Banc d'essai sans limite de taille, hors requête HTTP :
+        env['project.financial.data.importer'].browse(id).run_benchmark()
+        """
+        self.ensure_one()
+        if not self.project_financial_id:
+            raise UserError(_("Choisissez un projet financier pour le banc d'essai"))
+
+        results = [self._benchmark_import(size) for size in sizes]
+        self.report = '\n'.join(
+            _("%(rows)s lignes : %(rate).0f lignes/s, %(queries)s requêtes (%(seconds).2f s)") % result
+            for result in results
+        )
+        return results
+
+    def _benchmark_import(self, size):
+        """Importe un fichier synthétique de size lignes puis annule, retourne les mesures"""
+        axes = self.project_financial_id.axis_ids
+        if not axes:
+            raise UserError(_("Le projet %s n'a aucun axe") % self.project_financial_id.name)
+
+        importer = self.new({
+            'project_financial_id': self.project_financial_id.id,
+            'data_file': base64.b64encode(self._get_benchmark_file(axes, size)),
+            'data_filename': f'benchmark_{size}.csv',
+            'chunk_size': self.chunk_size,
+            'dry_run': self.dry_run,
+        })
+
+        self.env.flush_all()
+        # Les registres de recalcul (cumuls KPI...) remplis par l'import
+        # sont restaurés avec le savepoint
+        precommit_data = copy.deepcopy(self.env.cr.precommit.data)
+        queries = self.env.cr.sql_log_count
+        start = time.perf_counter()
+        try:
+            with self.env.cr.savepoint():
+                stats = importer._import_rows(importer._iter_rows())
+                self.env.flush_all()
+                raise _BenchmarkRollback()
+        except _BenchmarkRollback:
+            pass
+        finally:
+            self.env.cr.precommit.data.clear()
+            self.env.cr.precommit.data.update(precommit_data)
+        seconds = time.perf_counter() - start
+        queries = self.env.cr.sql_log_count - queries
+        self.env.invalidate_all()
+
+        version = self.env['ir.module.module'].search([('name', '=', 'somachame_finance')]).latest_version
+        result = {
+            'rows': stats['rows'],
+            'seconds': seconds,
+            'rate': stats['rows'] / seconds if seconds else 0.0,
+            'queries': queries,
+        }
+        _logger.info(
+            f"Benchmark import v{version}: {result['rows']} lignes, {result['rate']:.0f} lignes/s, "
+            f"{queries} requêtes, {len(stats['errors'])} erreurs"
+        )
+        return result
+
+    @api.model
+    def _get_benchmark_file(self, axes, size):
+        """CSV synthétique : une cellule (axe, mois) distincte par ligne depuis janvier 2000"""
+        stream = io.StringIO()
+        writer = csv.writer(stream, delimiter=';')
+        writer.writerow(['axis', 'month', 'acquise', 'cost', 'source'])
+        names = axes.mapped('name')
+        for index in range(size):
+            month_index = index // len(names)
+            writer.writerow([
+                names[index % len(names)],
+                f'{2000 + month_index // 12}-{month_index % 12 + 1:02d}',
+                f'{(index % 100) / 1000:.3f}',
+                f'{(index % 997) * 10.5:.2f}',
+                'benchmark',
+            ])
+        return stream.getvalue().encode()
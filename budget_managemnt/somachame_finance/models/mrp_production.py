@@ -1,9 +1,18 @@
 import logging
-from odoo import models, api
+from odoo import models, api, fields
 from collections import defaultdict
+from .product_category_mrp_ratio import PRODUCTION_PHASES
 
 _logger = logging.getLogger(__name__)
 
+
+class MrpWorkcenter(models.Model):
+    _inherit = 'mrp.workcenter'
+
+    financial_phase = fields.Selection(PRODUCTION_PHASES, string="Phase d'avancement",
+                                       help="Phase utilisée pour les ratios des axes 'Taux d'Avancement'")
+
+
 class MrpProduction(models.Model):
     _inherit = 'mrp.production'
     
@@ -19,6 +28,8 @@ class MrpProduction(models.Model):
                 _logger.info(f"Synchro production terminée: {production.name}")
                 production._sync_production_axes()
         
+        self.filtered(lambda p: p.state == 'done')._sync_rate_axes()
+        
         return res
     
     # def action_cancel(self):
@@ -33,14 +44,45 @@ class MrpProduction(models.Model):
         
     #     return super().action_cancel()
     
+    def _get_remaining_ratios(self):
+        """
+        Part non déconstruite de chaque OF, d'après ses déconstructions validées
+        Retourne {production_id: ratio entre 0 et 1}
+        """
+        unbuilt = defaultdict(float)
+        for unbuild in self.env['mrp.unbuild'].search([('mo_id', 'in', self.ids), ('state', '=', 'done')]):
+            unbuilt[unbuild.mo_id.id] += unbuild.product_uom_id._compute_quantity(
+                unbuild.product_qty, unbuild.mo_id.product_uom_id)
+        
+        ratios = {}
+        for production in self:
+            produced = production.qty_produced or production.product_qty
+            ratios[production.id] = max(1.0 - unbuilt[production.id] / produced, 0.0) if produced > 0 else 1.0
+        return ratios
+    
     def _sync_production_axes(self):
-        """Synchro des mouvements de production"""
+        """
+        Synchro des coûts des composants
+        La valeur acquise des axes 'Taux d'Avancement' est recalculée une seule fois, en lot, par _sync_rate_axes
+        """
         for move in self.move_raw_ids:
             if move._is_valid_for_axis_sync():
                 axis = move._get_financial_axes()
                 if axis:
                     move._update_axis_line_cost(axis)
     
+    def _sync_rate_axes(self):
+        """Recalcul incrémental des axes 'Taux d'Avancement' pour ces OF"""
+        if not self:
+            return
+        account_ids = self.move_raw_ids.mapped('analytic_account_id').ids
+        axes = self.env['project.financial.axis'].search([
+            ('project_financial_id.account_id', 'in', account_ids),
+            ('type', '=', 'rate'),
+        ])
+        if axes:
+            axes._compute_rate_earned_values(self.ids)
+    
     def _cleanup_production_axes(self):
         """Nettoyage des axes de production"""
         for move in self.move_raw_ids:
@@ -74,49 +116,79 @@ class MrpUnbuild(models.Model):
         return result
     
     def _prepare_axes_cleanup(self):
-        """Prépare les données de nettoyage des axes"""
-        cleanup_info = []
+        """
+        Prépare les montants à retirer des axes MRP
+        Les contributions d'origine des composants sont lues en une requête,
+        au prorata de la quantité déconstruite : coût imputé au mouvement,
+        à défaut son prix ou sa valorisation, jamais le coût standard du jour
+        Retourne {(axis_id, date): coût}
+        """
+        cells = defaultdict(float)
         
-        if self.mo_id and self.mo_id.state == 'done':
-            # Calculer le ratio de déconstruction
-            # total_produced = self.mo_id.product_uom_id._compute_quantity(
-            #     self.mo_id.qty_produced, self.product_uom_id
-            # )
-            # factor = self.product_qty / total_produced if total_produced > 0 else 0
+        for unbuild in self:
+            mo = unbuild.mo_id
+            if not mo or mo.state != 'done' or mo.type_operation != 'debitage':
+                continue
+            
+            produced = mo.qty_produced or mo.product_qty
+            quantity = unbuild.product_uom_id._compute_quantity(unbuild.product_qty, mo.product_uom_id)
+            factor = quantity / produced if produced > 0 else 0.0
+            
+            self.env.flush_all()
+            self.env.cr.execute("""
+                SELECT sm.id, sm.product_id, sm.analytic_account_id, pt.categ_id,
+                       mp.date_finished::date, sm.product_qty, ABS(COALESCE(sm.price_unit, 0)),
+                       COALESCE(sm.axis_cost, 0),
+                       COALESCE((SELECT SUM(-svl.value) FROM stock_valuation_layer svl
+                                 WHERE svl.stock_move_id = sm.id), 0),
+                       EXISTS(SELECT 1 FROM stock_valuation_layer svl WHERE svl.stock_move_id = sm.id)
+                FROM stock_move sm
+                JOIN mrp_production mp ON mp.id = sm.raw_material_production_id
+                JOIN stock_location loc ON loc.id = sm.location_dest_id
+                JOIN product_product pp ON pp.id = sm.product_id
+                JOIN product_template pt ON pt.id = pp.product_tmpl_id
+                WHERE sm.raw_material_production_id = %s
+                  AND sm.state = 'done'
+                  AND sm.product_qty > 0
+                  AND loc.usage = 'production'
+            """, [mo.id])
+            rows = self.env.cr.fetchall()
+            if not rows:
+                continue
+            
+            account_ids = {row[2] for row in rows}
+            categ_ids = {row[3] for row in rows}
+            axes = self.env['project.financial.axis'].search([
+                ('project_financial_id.account_id', 'in', list(account_ids)),
+                ('cost_type', '=', 'mrp'),
+            ])
+            categ_axis_maps = {
+                account_id: axes.filtered(lambda a: a.analytic_account_id.id == account_id)._get_category_axis_map(categ_ids)
+                for account_id in account_ids
+            }
             
-            # _logger.info(f"Déconstruction ratio: {factor} (qty: {self.product_qty} / produit: {total_produced})")
+            for move_id, _product_id, account_id, categ_id, date, qty, price_unit, axis_cost, layer_value, has_layer in rows:
+                if axis_cost:
+                    move_cost = axis_cost
+                elif price_unit:
+                    move_cost = qty * price_unit
+                elif has_layer:
+                    move_cost = layer_value
+                else:
+                    _logger.warning(f"Déconstruction {unbuild.name}: coût imputé inconnu pour le mouvement {move_id}")
+                    continue
+                for axis in categ_axis_maps[account_id].get(categ_id, []):
+                    cost = layer_value if axis.mrp_cost_source == 'valuation' and has_layer else move_cost
+                    cells[(axis.id, date)] += cost * factor
             
-            # Mouvements de composants à nettoyer
-            for move in self.mo_id.move_raw_ids.filtered(lambda m: m.state == 'done'):
-                if move._is_valid_for_axis_sync():
-                    axis = move._get_financial_axes()
-                    if axis:
-                        # quantity = move.quantity * factor
-                        cleanup_info.append({
-                            'axis': axis,
-                            'original_move_id': move.id,
-                            'date': move._get_move_date_for_axis(),
-                            # 'quantity': move.product_qty,
-                            'product': move.product_id.name,
-                            'price': move._get_product_cost_for_axis(),
-                        })
+            _logger.info(f"Déconstruction {unbuild.name}: ratio {factor:.4f}, {len(rows)} composants")
         
-        return cleanup_info
+        return cells
     
     def _cleanup_old_axes(self, cleanup_info):
-        """Nettoie les anciens axes"""
-        for info in cleanup_info:
-            if info['axis']:
-                # Utiliser un mouvement fictif pour le nettoyage
-                move = self.env['stock.move'].search([('origin_returned_move_id', '=', info.get('original_move_id'))], limit=1, order='id desc')
-                move._cleanup_old_axis(
-                    info['axis'],
-                    info['date'],
-                    move.product_qty,
-                    info['price'],
-                )
-                _logger.info(f"Nettoyé {move} de {info['product']}: {info['price']}DH & {move.product_qty}")
-                _logger.info(f"loriginal est : {info}")
+        """Retire en une mise à jour les coûts des composants déconstruits"""
+        lines = self.env['project.financial.axis.line']._subtract_cells(cleanup_info, 'actual_cost')
+        _logger.info(f"Déconstruction: {len(lines)} lignes d'axe nettoyées")
     
     def _sync_unbuild_axes(self):
         """Synchro des mouvements de déconstruction"""
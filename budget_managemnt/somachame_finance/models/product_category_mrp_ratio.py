@@ -7,6 +7,14 @@ from odoo.exceptions import ValidationError, UserError
 
 _logger = logging.getLogger(__name__)
 
+PRODUCTION_PHASES = [
+    ('debitage', 'Débitage'),
+    ('assemblage', 'Assemblage'),
+    ('soudage', 'Soudage'),
+    ('finition', 'Finition'),
+    ('peinture', 'Peinture'),
+]
+
 
 class ProductCategoryRatio(models.Model):
     _name = "product.category.mrp.ratio"
@@ -73,6 +81,11 @@ class ProductCategoryRatio(models.Model):
                 record.peinture_ratio
             ])
     
+    def _get_phase_ratio(self, phase):
+        """Ratio (0-1) de la phase pour cette catégorie"""
+        self.ensure_one()
+        return (self[f'{phase}_ratio'] or 0.0) / 100.0
+
     _sql_constraints = [
         ('category_uniq', 'UNIQUE(axis_id, product_category_id)',
          'Cette catégorie a déjà des ratios définis pour cet axe!'),
@@ -147,3 +160,121 @@ class ProjectFinancialAxis(models.Model):
         if axis.type == 'rate' and 'product_category_ids' in vals:
             axis._onchange_product_category_ids()
         return axis
+
+    def _get_ratio_for_category(self, category):
+        """
+        Ligne de ratio applicable à une catégorie produit :
+        la plus spécifique parmi les catégories de l'axe qui la couvrent
+        """
+        self.ensure_one()
+        matching = self.category_ratio_ids.filtered(
+            lambda r: category.parent_path.startswith(r.product_category_id.parent_path)
+        )
+        return matching.sorted(lambda r: len(r.product_category_id.parent_path), reverse=True)[:1]
+
+    @api.model
+    def _read_rate_phase_weights(self, account_ids, dates=None):
+        """
+        Poids produit par les opérations terminées, par phase d'atelier
+        Retourne {(compte analytique, date, catégorie produit, phase): poids}
+        """
+        if not account_ids:
+            return {}
+        
+        self.env.flush_all()
+        query = """
+            SELECT acc.account_id,
+                   wo.date_finished::date,
+                   pt.categ_id,
+                   wc.financial_phase,
+                   SUM(wo.qty_produced * COALESCE(pp.weight, 0))
+            FROM mrp_workorder wo
+            JOIN mrp_workcenter wc ON wc.id = wo.workcenter_id
+            JOIN mrp_production mp ON mp.id = wo.production_id
+            JOIN product_product pp ON pp.id = mp.product_id
+            JOIN product_template pt ON pt.id = pp.product_tmpl_id
+            JOIN (
+                SELECT DISTINCT raw_material_production_id AS production_id,
+                                analytic_account_id AS account_id
+                FROM stock_move
+                WHERE raw_material_production_id IS NOT NULL
+                  AND analytic_account_id IN %s
+            ) acc ON acc.production_id = mp.id
+            WHERE wo.state = 'done'
+              AND wo.date_finished IS NOT NULL
+              AND wc.financial_phase IS NOT NULL
+        """
+        params = [tuple(account_ids)]
+        if dates:
+            query += " AND wo.date_finished::date IN %s"
+            params.append(tuple(dates))
+        query += " GROUP BY acc.account_id, wo.date_finished::date, pt.categ_id, wc.financial_phase"
+        
+        self.env.cr.execute(query, params)
+        return {(account_id, date, categ_id, phase): weight
+                for account_id, date, categ_id, phase, weight in self.env.cr.fetchall()}
+
+    def _compute_rate_earned_values(self, production_ids=None):
+        """
+        Valeur acquise des axes 'Taux d'Avancement' (type='rate')
+        Poids produit par phase × ratio de la catégorie pour cette phase,
+        en un seul passage pour tous les ordres de fabrication du projet.
+        Le % acquis est ensuite rapporté au poids planifié de l'axe.
+        
+        production_ids: recalcul incrémental limité aux dates touchées par ces OF
+        """
+        axes = self.filtered(lambda a: a.type == 'rate' and a.analytic_account_id)
+        if not axes:
+            return self.env['project.financial.axis.line']
+        
+        account_ids = axes.mapped('analytic_account_id').ids
+        dates = None
+        if production_ids:
+            workorders = self.env['mrp.workorder'].search([
+                ('production_id', 'in', production_ids),
+                ('state', '=', 'done'),
+                ('date_finished', '!=', False),
+            ])
+            dates = {wo.date_finished.date() for wo in workorders}
+            if not dates:
+                return self.env['project.financial.axis.line']
+        
+        weights = self._read_rate_phase_weights(account_ids, dates)
+        categories = self.env['product.category'].browse({key[2] for key in weights})
+        
+        cells = defaultdict(float)
+        for axis in axes:
+            ratios = {category.id: axis._get_ratio_for_category(category) for category in categories}
+            for (account_id, date, categ_id, phase), weight in weights.items():
+                ratio = ratios.get(categ_id)
+                if account_id != axis.analytic_account_id.id or not ratio:
+                    continue
+                cells[(axis.id, date)] += weight * ratio._get_phase_ratio(phase)
+        
+        # Remettre à zéro les dates recalculées qui n'ont plus de production
+        domain = [('axis_id', 'in', axes.ids), ('is_default', '=', False)]
+        if dates:
+            domain.append(('date', 'in', list(dates)))
+        for line in self.env['project.financial.axis.line'].search(domain):
+            cells.setdefault((line.axis_id.id, line.date), 0.0)
+        
+        lines = self.env['project.financial.axis.line']._upsert_cells(
+            {key: {'earned_value': value} for key, value in cells.items()},
+            ['earned_value'],
+        )
+        _logger.info(f"Taux d'avancement: {len(cells)} cellules recalculées pour {len(axes)} axes")
+        return lines
+
+    def action_compute_rate_earned_values(self):
+        """Recalcule toute la valeur acquise des axes 'Taux d'Avancement'"""
+        self._compute_rate_earned_values()
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Taux d\'avancement'),
+                'message': _('Valeur acquise recalculée pour %s axe(s).') % len(self),
+                'type': 'success',
+                'sticky': False,
+            }
+        }
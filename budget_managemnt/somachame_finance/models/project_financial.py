@@ -1,5 +1,6 @@
 import logging
 from odoo import api, fields, models, _
+from odoo.tools import split_every
 from collections import defaultdict
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
@@ -7,6 +8,10 @@ from odoo.exceptions import ValidationError, UserError
 
 _logger = logging.getLogger(__name__)
 
+# Champs d'axe dont dépendent les champs stockés des lignes
+LINE_DEPENDENCY_FIELDS = ['budget_unit', 'planned_quantity', 'mrp_planned_weight', 'type']
+STORED_DEPENDENT_FIELDS = ['axis_planned_quantity', 'earned_amount', 'acquise_value', 'grid_cost']
+
 
 # project.financial is the same domain as project.projct 1.1
 class ProjectFinancialProgress(models.Model):
@@ -484,45 +489,17 @@ class ProjectFinancialProgress(models.Model):
     
     def action_import_all_financial_data(self):
         """
-        Action pour importer TOUTES les données financières depuis l'interface
+        Action pour importer les données financières (CSV/XLSX) depuis l'interface
         """
         self.ensure_one()
-        
-        try:
-            importer = self.env['project.financial.data.importer']
-            result = importer.import_financial_data(self.id)
-            
-            # Notification de succès
-            return {
-                'type': 'ir.actions.client',
-                'tag': 'display_notification',
-                'params': {
-                    'title': _('Import terminé'),
-                    'message': result['message'],
-                    'type': 'success',
-                    'sticky': True,
-                    'next': {
-                        'type': 'ir.actions.act_window',
-                        'res_model': 'project.financial.axis.line',
-                        'view_mode': 'tree,graph',
-                        'name': _('Lignes importées'),
-                        'domain': [('id', 'in', result['acquise_line_ids'] + result['cost_line_ids'])],
-                        'context': {'group_by': 'date:month'},
-                    }
-                }
-            }
-            
-        except Exception as e:
-            return {
-                'type': 'ir.actions.client',
-                'tag': 'display_notification',
-                'params': {
-                    'title': _('Erreur lors de l\'import'),
-                    'message': _('Une erreur est survenue: %s') % str(e),
-                    'type': 'danger',
-                    'sticky': True,
-                }
-            }
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('Importer Données Financières'),
+            'res_model': 'project.financial.data.importer',
+            'view_mode': 'form',
+            'target': 'current',
+            'context': {'default_project_financial_id': self.id},
+        }
     
     def action_view_imported_lines(self):
         """Voir toutes les lignes importées"""
@@ -672,13 +649,13 @@ class ProjectFinancialProgress(models.Model):
         ])
         
         count = 0
-        for invoice in invoices:
+        if invoices:
             try:
-                # Utiliser la méthode batch
-                invoice._sync_all_project_invoices(cleanup=False)
-                count += 1
+                # Une seule agrégation couvre toutes les factures du projet
+                invoices[0]._sync_all_project_invoices(cleanup=False)
+                count = len(invoices)
             except Exception as e:
-                _logger.error(f"   → ERREUR facture {invoice.id}: {str(e)}")
+                _logger.error(f"   → ERREUR factures projet {self.project_id.name}: {str(e)}")
         
         _logger.info(f"   → {len(invoices)} factures traitées")
         return count
@@ -757,7 +734,10 @@ class ProjectFinancialProgress(models.Model):
                     continue  # Pas d'axe correspondant
                 
                 for axis in axes:
-                    if axis.cost_type == 'mrp':
+                    if axis.cost_type == 'mrp' and axis.mrp_cost_source == 'valuation':
+                        # Agrégé en SQL depuis les couches de valorisation (voir plus bas)
+                        continue
+                    elif axis.cost_type == 'mrp':
                         # Coût de production (composants) - utiliser la fonction de stock.move
                         try:
                             cost = move._get_product_cost_for_axis()
@@ -792,6 +772,12 @@ class ProjectFinancialProgress(models.Model):
                 errors_count += 1
                 _logger.error(f"   → ERREUR mouvement {move.id}: {str(e)}")
         
+        # Coûts MRP issus des couches de valorisation, agrégés en une requête
+        valuation_costs = StockMove._get_valuation_costs_for_axes(mrp_axes)
+        for axis_id, date_values in valuation_costs.items():
+            for date_str, cost in date_values.items():
+                axis_cost_data[axis_id][date_str] += cost
+        
         # RÉCAPITULATIF AVANT CRÉATION
         _logger.info(f"   → Résumé regroupement:")
         _logger.info(f"      - Axes MRP avec données: {len(axis_cost_data)}")
@@ -1034,6 +1020,14 @@ class ProjectFinancialAxis(models.Model):
                                    help="Requis pour les calcules et la synchronisation avec autres bases ")
     product_category_ids =  fields.Many2many('product.category', string="Catégorie produit")
     mrp_planned_weight = fields.Float(string="Poids planifier")
+    mrp_cost_source = fields.Selection([
+            ('move', 'Prix du mouvement'),
+            ('valuation', 'Valorisation de stock'),
+        ],
+        string="Valorisation MRP", required=True,
+        default='move',
+        help="Prix du mouvement : prix unitaire du mouvement (ou coût standard) au moment de la synchronisation.\n"
+             "Valorisation de stock : somme des couches de valorisation, reproductible et agrégée en SQL.")
     # employee_department_ids = fields.Many2many('hr.department', string="Département")
     employee_ids = fields.Many2many('hr.employee', string="Main d'Oeuvre")
     mrp_id = fields.Many2one('mrp.workcenter', string="Phase de Fabrication")
@@ -1072,7 +1066,24 @@ class ProjectFinancialAxis(models.Model):
         if ((self.type == 'rate' or vals.get('type') == 'rate') and
            'mrp_planned_weight' in vals and vals.get('mrp_planned_weight') <= 0):
             raise UserError("Le champ 'Poids planifier' ne peut pas étre inférieur à 0.")
-        return super().write(vals)       
+        result = super().write(vals)
+        if any(field in vals for field in LINE_DEPENDENCY_FIELDS):
+            self._recompute_line_dependents()
+        return result
+
+    def _recompute_line_dependents(self):
+        """
+        Met à jour en une requête les champs stockés des lignes qui dépendent
+        du prix unitaire, de la quantité ou du poids de l'axe
+        """
+        if not self:
+            return
+        self.flush_recordset(LINE_DEPENDENCY_FIELDS)
+        lines = self.env['project.financial.axis.line']._recompute_stored_dependents(
+            'line.axis_id = ANY(%s)', [self.ids])
+        # La VA mensuelle change sur tout l'historique des axes
+        self.env['project.financial.axis.kpi']._mark_cumulatives_dirty((axis_id, None) for axis_id in self.ids)
+        _logger.info(f"Axes {self.ids}: {len(lines)} lignes recalculées")
 
     
     @api.constrains('employee_ids' ,'product_category_ids', 'project_financial_id')
@@ -1164,6 +1175,21 @@ class ProjectFinancialAxis(models.Model):
 
         return domain
 
+    def _get_category_axis_map(self, categ_ids):
+        """
+        Associe chaque catégorie produit aux axes de self qui la couvrent
+        (catégorie de l'axe ou une de ses sous-catégories), via parent_path.
+        Retourne {categ_id: axes}
+        """
+        categ_axis_map = defaultdict(lambda: self.browse())
+        categories = self.env['product.category'].browse(categ_ids)
+        for axis in self:
+            paths = axis.product_category_ids.mapped('parent_path')
+            for category in categories:
+                if any(category.parent_path.startswith(path) for path in paths):
+                    categ_axis_map[category.id] |= axis
+        return categ_axis_map
+
     def _get_all_child_category_ids(self):
         """
         Récupère tous les IDs des catégories enfants (et les catégories sélectionnées elles-mêmes)
@@ -1532,11 +1558,12 @@ class ProjectFinancialAxisLine(models.Model):
         for line in self:
             line.earned_amount = line.earned_value * line.axis_id.budget_unit
 
-    @api.depends('date', 'axis_planned_quantity', 'earned_value', 'axis_id.mrp_planned_weight')
+    @api.depends('date', 'axis_planned_quantity', 'earned_value', 'axis_id.mrp_planned_weight', 'axis_id.type')
     def _compute_acquise(self):
         for line in self:
-            if line.axid_id.type == 'rate':
-                line.acquise_value = line.earned_value / line.axis_id.mrp_planned_weight
+            if line.axis_id.type == 'rate':
+                line.acquise_value = line.earned_value / line.axis_id.mrp_planned_weight \
+                    if line.axis_id.mrp_planned_weight != 0 else 0.0
             else:
                 line.acquise_value = line.earned_value / line.axis_planned_quantity \
                     if line.axis_planned_quantity != 0 else 0.0
@@ -1551,53 +1578,6 @@ class ProjectFinancialAxisLine(models.Model):
             else:
                 record.earned_value = 0.0
 
-    # @api.depends('date', 'actual_cost', 'earned_amount')
-    def _compute_cost(self):
-        for line in self:
-            if line.earned_amount != 0:
-                return line._get_performance(
-                    'cost_performance_index', 'actual_cost', line.axis_id, 
-                    line.date, 0.0, True)
-    
-    # @api.depends('date', 'axis_id.planned_budget', 'earned_amount')
-    def _compute_delay(self):
-        for line in self:
-            if line.axis_id.planned_budget != 0:
-                return line._get_performance(
-                    'delay_performance_index', 'earned_amount', line.axis_id, 
-                    line.date, line.axis_id.planned_budget)
-    
-    def _get_performance(self, field, src_field, axis, date, value, is_cost=False):
-            lines = self.env['project.financial.axis.line']
-            line_month = date.month
-            line_year = date.year
-            start_date = fields.Date.to_date(f'{line_year}-{line_month:02d}-01')
-            index = 0
-            
-            domain = [
-                ('axis_id', '=', axis.id),
-                ('date', '>=', start_date),
-                ('date', '<=', fields.Date.end_of(date, 'month')),
-            ]
-            month_lines = lines.search(domain)            
-            monthly_value = sum(month_lines.mapped(src_field))
-            if is_cost:
-                monthly_earned_amount = sum(month_lines.mapped('earned_amount'))
-                index = monthly_earned_amount / monthly_value if monthly_value != 0.0 else 0.0
-            else:
-                index = monthly_value / value
-            
-            debut = lines.search([('axis_id', '=', axis.id),
-                ('date', '=', start_date)], limit=1)
-            if debut:
-                debut.write({field: index})
-            else:
-                lines.create({
-                    'date': date,
-                    'axis_id': axis.id,
-                    field: index,
-                })
-
     # def _compute_performance(self):
     #     for line in self:
     #         line.cost_performance_index = line.earned_amount / line.actual_cost if line.actual_cost != 0 else 0.0
@@ -1617,6 +1597,138 @@ class ProjectFinancialAxisLine(models.Model):
     # ], string="KPI Type", required=True, index=True)
 
     # value = fields.Float(string="Value", required=True)
+    @api.model
+    def _upsert_cells(self, cells, fnames, mode='set'):
+        """
+        Insère ou met à jour en masse les lignes d'axe par (axis_id, date)
+        cells: {(axis_id, date): {champ: valeur}}
+        mode 'set' remplace les valeurs existantes, 'add' les cumule
+        Retourne les lignes touchées
+        """
+        if not cells:
+            return self.browse()
+        
+        self.env.flush_all()
+        columns = ', '.join(fnames)
+        values = ', '.join(f"v.{fname}" for fname in fnames)
+        if mode == 'add':
+            updates = ', '.join(f"{fname} = COALESCE(line.{fname}, 0) + EXCLUDED.{fname}" for fname in fnames)
+        else:
+            updates = ', '.join(f"{fname} = EXCLUDED.{fname}" for fname in fnames)
+        
+        line_ids = []
+        for chunk in split_every(1000, cells.items()):
+            rows = [
+                (axis_id, date, *[vals.get(fname, 0.0) for fname in fnames])
+                for (axis_id, date), vals in chunk
+            ]
+            self.env.cr.execute(f"""
+                INSERT INTO project_financial_axis_line AS line
+                    (axis_id, project_financial_id, currency_id, axis_planned_quantity,
+                     date, {columns}, is_default, create_uid, create_date, write_uid, write_date)
+                SELECT axis.id, axis.project_financial_id, axis.currency_id, axis.planned_quantity,
+                       v.date::date, {values}, false,
+                       %s, now() at time zone 'UTC', %s, now() at time zone 'UTC'
+                FROM (VALUES {', '.join(['%s'] * len(rows))}) AS v(axis_id, date, {columns})
+                JOIN project_financial_axis axis ON axis.id = v.axis_id
+                ON CONFLICT (axis_id, date) DO UPDATE
+                SET {updates}, write_uid = EXCLUDED.write_uid, write_date = EXCLUDED.write_date
+                RETURNING line.id
+            """, [self.env.uid, self.env.uid, *rows])
+            line_ids += [row[0] for row in self.env.cr.fetchall()]
+        
+        # Recalculer les champs stockés dépendants (VA, % acquise, coût grid)
+        lines = self.browse(line_ids)
+        lines.invalidate_recordset()
+        lines.modified(['axis_id', *fnames])
+        lines._recompute_stored_dependents('line.id = ANY(%s)', [lines.ids])
+        self.env['project.financial.axis.kpi']._mark_cumulatives_dirty(cells)
+        _logger.info(f"Upsert axes: {len(line_ids)} lignes ({', '.join(fnames)}, mode {mode})")
+        return lines
+
+    @api.model
+    def _recompute_stored_dependents(self, where, params):
+        """
+        Recalcule en SQL VA, % acquise, coût grid et quantité prévue des lignes
+        filtrées par where (sur l'alias line), à partir de leur axe, et les
+        retire des calculs ORM en attente
+        Retourne les lignes touchées
+        """
+        self.flush_model(['earned_value', 'actual_cost'])
+        self.env.cr.execute(f"""
+            UPDATE project_financial_axis_line line
+            SET axis_planned_quantity = axis.planned_quantity,
+                earned_amount = COALESCE(line.earned_value, 0) * COALESCE(axis.budget_unit, 0),
+                acquise_value = COALESCE(line.earned_value / NULLIF(
+                    CASE WHEN axis.type = 'rate' THEN axis.mrp_planned_weight
+                         ELSE axis.planned_quantity END, 0), 0),
+                grid_cost = COALESCE(line.actual_cost, 0)
+            FROM project_financial_axis axis
+            WHERE axis.id = line.axis_id AND {where}
+            RETURNING line.id
+        """, params)
+        lines = self.browse([row[0] for row in self.env.cr.fetchall()])
+        for fname in STORED_DEPENDENT_FIELDS:
+            self.env.remove_to_compute(self._fields[fname], lines)
+        lines.invalidate_recordset(STORED_DEPENDENT_FIELDS)
+        lines.modified(STORED_DEPENDENT_FIELDS)
+        return lines
+
+    @api.model
+    def _subtract_cells(self, cells, fname):
+        """
+        Soustrait en masse des montants des lignes d'axe par (axis_id, date)
+        Les valeurs sont bornées à 0 et les incohérences (ligne absente,
+        montant supérieur au solde) sont journalisées en un seul rapport
+        cells: {(axis_id, date): montant}
+        Retourne les lignes touchées
+        """
+        if not cells:
+            return self.browse()
+        
+        self.env.flush_all()
+        line_ids = []
+        found = set()
+        clamped = []
+        for chunk in split_every(1000, cells.items()):
+            rows = [(axis_id, date, abs(amount)) for (axis_id, date), amount in chunk]
+            self.env.cr.execute(f"""
+                WITH v(axis_id, date, amount) AS (VALUES {', '.join(['%s'] * len(rows))}),
+                old AS (
+                    SELECT line.id, v.axis_id, v.date::date AS date,
+                           COALESCE(line.{fname}, 0) AS value, v.amount
+                    FROM project_financial_axis_line line
+                    JOIN v ON line.axis_id = v.axis_id AND line.date = v.date::date
+                    FOR UPDATE OF line
+                )
+                UPDATE project_financial_axis_line line
+                SET {fname} = GREATEST(old.value - old.amount, 0),
+                    write_uid = %s, write_date = now() at time zone 'UTC'
+                FROM old
+                WHERE line.id = old.id
+                RETURNING line.id, old.axis_id, old.date, old.value, old.amount
+            """, [*rows, self.env.uid])
+            for line_id, axis_id, date, value, amount in self.env.cr.fetchall():
+                line_ids.append(line_id)
+                found.add((axis_id, date))
+                if amount - value > 0.01:
+                    clamped.append((axis_id, date, value, amount))
+        
+        missing = [key for key in cells if (key[0], fields.Date.to_date(key[1])) not in found]
+        if clamped or missing:
+            _logger.warning(
+                f"Soustraction {fname}: {len(clamped)} ligne(s) bornée(s) à 0, "
+                f"{len(missing)} ligne(s) absente(s)\n"
+                + "\n".join(f"  axe {a} au {d}: solde {v:.2f} < {m:.2f}" for a, d, v, m in clamped)
+                + "".join(f"\n  axe {a} au {d}: aucune ligne" for a, d in missing)
+            )
+        
+        lines = self.browse(line_ids)
+        lines.invalidate_recordset()
+        lines.modified([fname])
+        self.env['project.financial.axis.kpi']._mark_cumulatives_dirty(cells)
+        return lines
+
     def _sync_kpi_lines(self):
         KPI = self.env["project.financial.axis.kpi"].sudo()
         for line in self:
@@ -0,0 +1,170 @@
+import logging
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+from odoo.tools import split_every
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_logger = logging.getLogger(__name__)
+
+# Champs de prévision communs aux axes et aux projets
+FORECAST_FIELDS = ['forecast_eac', 'forecast_etc', 'forecast_vac', 'forecast_tcpi', 'forecast_eac_composite']
+
+
+def _safe_divide(numerator, denominator):
+    """Division terme à terme, 0 là où le dénominateur est nul"""
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+
+
+def compute_evm_forecasts(bac, ev, ac, pv):
+    """
+    Prévisions EVM vectorisées sur des tableaux alignés
+    bac: budget à l'achèvement, ev: VA cumulée, ac: CR cumulé, pv: VP cumulée
+    Sans indice exploitable, le reste à faire est estimé au budget (EAC = CR + BAC - VA)
+    Retourne {champ: tableau}
+    """
+    cpi = _safe_divide(ev, ac)
+    spi = _safe_divide(ev, pv)
+    composite = cpi * spi
+    remaining = bac - ev
+    
+    eac = np.where(cpi > 0, _safe_divide(bac, cpi), ac + remaining)
+    eac_composite = np.where(composite > 0, ac + _safe_divide(remaining, composite), ac + remaining)
+    return {
+        'forecast_eac': eac,
+        'forecast_etc': eac - ac,
+        'forecast_vac': bac - eac,
+        'forecast_tcpi': _safe_divide(remaining, bac - ac),
+        'forecast_eac_composite': eac_composite,
+    }
+
+
+def compute_portfolio_forecasts(rows):
+    """
+    Prévisions des axes et de leurs projets à partir des lignes
+    (axis_id, project_id, bac, ev, ac, pv) ; les projets agrègent leurs axes
+    (sommes puis mêmes formules)
+    Retourne (axis_ids, prévisions axes, project_ids, prévisions projets)
+    """
+    data = np.array([row[2:] for row in rows], dtype=float).reshape(-1, 4)
+    bac, ev, ac, pv = data.T
+    axis_forecasts = compute_evm_forecasts(bac, ev, ac, pv)
+    
+    projects, inverse = np.unique(np.array([row[1] for row in rows]), return_inverse=True)
+    project_totals = [np.bincount(inverse, weights=column, minlength=len(projects)) for column in (bac, ev, ac, pv)]
+    project_forecasts = compute_evm_forecasts(*project_totals)
+    return [row[0] for row in rows], axis_forecasts, projects.tolist(), project_forecasts
+
+
+class ProjectFinancialAxis(models.Model):
+    _inherit = "project.financial.axis"
+
+    forecast_eac = fields.Monetary(string="EAC", currency_field='currency_id', readonly=True,
+                                   help="Estimation à l'achèvement : BAC / IPC")
+    forecast_etc = fields.Monetary(string="ETC", currency_field='currency_id', readonly=True,
+                                   help="Reste à dépenser : EAC - CR")
+    forecast_vac = fields.Monetary(string="VAC", currency_field='currency_id', readonly=True,
+                                   help="Écart à l'achèvement : BAC - EAC")
+    forecast_tcpi = fields.Float(string="TCPI", digits=(16, 4), readonly=True,
+                                 help="Indice de performance à atteindre : (BAC - VA) / (BAC - CR)")
+    forecast_eac_composite = fields.Monetary(string="EAC (IPC x IPD)", currency_field='currency_id', readonly=True,
+                                             help="CR + (BAC - VA) / (IPC x IPD)")
+    forecast_date = fields.Date(string="Date de prévision", readonly=True)
+
+
+class ProjectFinancialProgress(models.Model):
+    _inherit = "project.financial.progress"
+
+    forecast_eac = fields.Monetary(string="EAC", readonly=True,
+                                   help="Estimation à l'achèvement : BAC / IPC")
+    forecast_etc = fields.Monetary(string="ETC", readonly=True,
+                                   help="Reste à dépenser : EAC - CR")
+    forecast_vac = fields.Monetary(string="VAC", readonly=True,
+                                   help="Écart à l'achèvement : BAC - EAC")
+    forecast_tcpi = fields.Float(string="TCPI", digits=(16, 4), readonly=True,
+                                 help="Indice de performance à atteindre : (BAC - VA) / (BAC - CR)")
+    forecast_eac_composite = fields.Monetary(string="EAC (IPC x IPD)", readonly=True,
+                                             help="CR + (BAC - VA) / (IPC x IPD)")
+    forecast_date = fields.Date(string="Date de prévision", readonly=True)
+
+    def action_compute_forecasts(self):
+        """Recalcule les prévisions EVM des projets"""
+        if np is None:
+            raise UserError(_("Le calcul des prévisions nécessite la bibliothèque Python numpy"))
+        self._compute_evm_forecasts(self.ids)
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Prévisions recalculées'),
+                'message': _('Les prévisions EAC, ETC, VAC et TCPI ont été mises à jour.'),
+                'type': 'success',
+                'sticky': False,
+                'next': {'type': 'ir.actions.act_window_close'},
+            }
+        }
+
+    @api.model
+    def _cron_compute_evm_forecasts(self):
+        """Prévisions du portefeuille après les cumuls, ignorées sans numpy"""
+        if np is None:
+            _logger.warning("Prévisions EVM ignorées : la bibliothèque Python numpy n'est pas installée")
+            return
+        self._compute_evm_forecasts()
+
+    @api.model
+    def _compute_evm_forecasts(self, project_ids=None):
+        """
+        Prévisions EVM des axes puis des projets en un passage vectorisé
+        Le dernier cumul mensuel (jusqu'au mois courant) de chaque axe est
+        chargé en une requête ; les projets agrègent leurs axes
+        project_ids: limite aux projets (None : tout le portefeuille)
+        Nécessite numpy : les appelants vérifient sa présence
+        """
+        self.env.flush_all()
+        query = """
+            SELECT axis.id, axis.project_financial_id, COALESCE(axis.planned_budget, 0),
+                   COALESCE(kpi.cum_earned_amount, 0), COALESCE(kpi.cum_actual_cost, 0),
+                   COALESCE(kpi.cum_planned_budget, 0)
+            FROM project_financial_axis axis
+            LEFT JOIN LATERAL (
+                SELECT cum_earned_amount, cum_actual_cost, cum_planned_budget
+                FROM project_financial_axis_kpi
+                WHERE axis_id = axis.id AND month_date <= %s
+                ORDER BY month_date DESC
+                LIMIT 1
+            ) kpi ON TRUE
+            WHERE axis.active
+        """
+        params = [fields.Date.start_of(fields.Date.today(), 'month')]
+        if project_ids:
+            query += " AND axis.project_financial_id IN %s"
+            params.append(tuple(project_ids))
+        self.env.cr.execute(query, params)
+        rows = self.env.cr.fetchall()
+        if not rows:
+            return
+        
+        axis_ids, axis_forecasts, project_ids, project_forecasts = compute_portfolio_forecasts(rows)
+        self._store_forecasts('project_financial_axis', axis_ids, axis_forecasts)
+        self._store_forecasts('project_financial_progress', project_ids, project_forecasts)
+        self.env['project.financial.axis'].invalidate_model(FORECAST_FIELDS + ['forecast_date'])
+        self.invalidate_model(FORECAST_FIELDS + ['forecast_date'])
+        _logger.info(f"Prévisions EVM: {len(axis_ids)} axes, {len(project_ids)} projets")
+
+    @api.model
+    def _store_forecasts(self, table, ids, forecasts):
+        """Écrit les prévisions en masse par UPDATE ... FROM VALUES"""
+        values = list(zip(ids, *[forecasts[fname].tolist() for fname in FORECAST_FIELDS]))
+        assignments = ', '.join(f"{fname} = v.{fname}" for fname in FORECAST_FIELDS)
+        for chunk in split_every(1000, values):
+            self.env.cr.execute(f"""
+                UPDATE {table} AS rec
+                SET {assignments}, forecast_date = %s,
+                    write_uid = %s, write_date = now() at time zone 'UTC'
+                FROM (VALUES {', '.join(['%s'] * len(chunk))}) AS v(id, {', '.join(FORECAST_FIELDS)})
+                WHERE rec.id = v.id
+            """, [fields.Date.today(), self.env.uid, *chunk])
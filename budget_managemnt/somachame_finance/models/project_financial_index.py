@@ -0,0 +1,155 @@
+import json
+import logging
+from odoo import api, fields, models, _
+from odoo.tools import create_index
+
+_logger = logging.getLogger(__name__)
+
+# Requêtes de lecture les plus fréquentes du module, vérifiées par l'assistant d'index
+# (libellé, requête, paramètres construits à partir d'un échantillon de la base)
+HOT_QUERIES = [
+    ("Lignes d'axe par axe et période", """
+        SELECT id FROM project_financial_axis_line
+        WHERE axis_id = %(axis_id)s AND date >= %(date_from)s AND date <= %(date_to)s
+    """),
+    ("Lignes d'axe par projet et date", """
+        SELECT id FROM project_financial_axis_line
+        WHERE project_financial_id = %(project_id)s AND date <= %(date_to)s
+    """),
+    ("Ligne d'axe par défaut", """
+        SELECT id FROM project_financial_axis_line
+        WHERE axis_id = %(axis_id)s AND is_default
+    """),
+    ("Budgets mensuels par axe et date", """
+        SELECT id FROM project_financial_axis_budget_line
+        WHERE axis_id = %(axis_id)s AND date <= %(date_to)s
+    """),
+    ("Axes par projet et source de coût", """
+        SELECT id FROM project_financial_axis
+        WHERE project_financial_id = %(project_id)s AND cost_type = 'mrp'
+    """),
+    ("Axes par projet, emplacement reçu et type", """
+        SELECT id FROM project_financial_axis
+        WHERE project_financial_id = %(project_id)s AND location_dest_id = %(location_id)s AND type = 'stock'
+    """),
+    ("Projets par compte analytique", """
+        SELECT id FROM project_financial_progress
+        WHERE account_id = %(account_id)s
+    """),
+    ("Cumuls KPI d'un projet", """
+        SELECT id FROM project_financial_axis_kpi
+        WHERE project_financial_id = %(project_id)s
+        ORDER BY month_date
+    """),
+]
+
+
+class ProjectFinancialAxisLine(models.Model):
+    _inherit = "project.financial.axis.line"
+
+    def init(self):
+        super().init()
+        # (axis_id, date) est couvert par la contrainte unique axis_date_uniq
+        create_index(self.env.cr, 'project_financial_axis_line_project_date_index',
+                     self._table, ['project_financial_id', 'date'])
+        create_index(self.env.cr, 'project_financial_axis_line_default_index',
+                     self._table, ['axis_id'], where='is_default')
+
+
+class ProjectFinancialAxisBudgetLine(models.Model):
+    _inherit = "project.financial.axis.budget.line"
+
+    def init(self):
+        super().init()
+        create_index(self.env.cr, 'project_financial_axis_budget_line_axis_date_index',
+                     self._table, ['axis_id', 'date'])
+
+
+class ProjectFinancialAxis(models.Model):
+    _inherit = "project.financial.axis"
+
+    def init(self):
+        super().init()
+        create_index(self.env.cr, 'project_financial_axis_project_cost_type_index',
+                     self._table, ['project_financial_id', 'cost_type'])
+        create_index(self.env.cr, 'project_financial_axis_project_location_type_index',
+                     self._table, ['project_financial_id', 'location_dest_id', 'type'],
+                     where='location_dest_id IS NOT NULL')
+
+
+class ProjectFinancialProgress(models.Model):
+    _inherit = "project.financial.progress"
+
+    def init(self):
+        super().init()
+        create_index(self.env.cr, 'project_financial_progress_account_index',
+                     self._table, ['account_id'], where='account_id IS NOT NULL')
+
+    @api.model
+    def _get_index_advisor_params(self):
+        """Échantillon de valeurs réelles pour les paramètres des requêtes"""
+        self.env.cr.execute("""
+            SELECT axis.id, axis.project_financial_id, axis.location_dest_id, pfp.account_id
+            FROM project_financial_axis axis
+            JOIN project_financial_progress pfp ON pfp.id = axis.project_financial_id
+            ORDER BY axis.id DESC
+            LIMIT 1
+        """)
+        axis_id, project_id, location_id, account_id = self.env.cr.fetchone() or (0, 0, 0, 0)
+        today = fields.Date.today()
+        return {
+            'axis_id': axis_id,
+            'project_id': project_id,
+            'location_id': location_id or 0,
+            'account_id': account_id or 0,
+            'date_from': fields.Date.start_of(today, 'year'),
+            'date_to': today,
+        }
+
+    @api.model
+    def _explain_hot_queries(self):
+        """
+        EXPLAIN des requêtes fréquentes sur la base courante
+        Retourne [(libellé, coût estimé, [tables parcourues séquentiellement])]
+        """
+        self.env.flush_all()
+        params = self._get_index_advisor_params()
+        results = []
+        for label, query in HOT_QUERIES:
+            self.env.cr.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+            plan = self.env.cr.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            plan = plan[0]['Plan']
+            
+            seq_scans = []
+            nodes = [plan]
+            while nodes:
+                node = nodes.pop()
+                if node.get('Node Type') == 'Seq Scan':
+                    seq_scans.append(node.get('Relation Name'))
+                nodes.extend(node.get('Plans', []))
+            results.append((label, plan.get('Total Cost', 0.0), seq_scans))
+        return results
+
+    @api.model
+    def action_index_advisor(self):
+        """Rapport des parcours séquentiels des requêtes fréquentes"""
+        results = self._explain_hot_queries()
+        warnings = [(label, cost, scans) for label, cost, scans in results if scans]
+        report = "\n".join(
+            f"{label}: parcours séquentiel de {', '.join(scans)} (coût {cost:.2f})"
+            for label, cost, scans in warnings
+        ) or _("Toutes les requêtes fréquentes utilisent un index.")
+        _logger.info(f"Assistant d'index: {len(warnings)}/{len(results)} requêtes en parcours séquentiel\n{report}")
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _("Assistant d'index : %s requête(s) en parcours séquentiel", len(warnings)),
+                'message': report + ("\n" + _("Les petites tables sont parcourues séquentiellement par choix du planificateur.")
+                                     if warnings else ""),
+                'type': 'warning' if warnings else 'success',
+                'sticky': bool(warnings),
+            }
+        }
@@ -1,4 +1,25 @@
+import hashlib
+import json
+import logging
+import time
+from collections import defaultdict
+from babel.dates import format_date
 from odoo import models, fields, api
+from odoo.models import READ_GROUP_DISPLAY_FORMAT
+from odoo.osv import expression
+from odoo.tools import ormcache, split_every
+from odoo.tools.misc import get_lang
+
+_logger = logging.getLogger(__name__)
+
+PORTFOLIO_STATE_PARAM = 'somachame_finance.kpi_portfolio_state'
+
+# Mesures des grilles de lignes d'axe servies par les cumuls mensuels
+GRID_ROLLUP_MEASURES = {
+    'grid_cost': 'monthly_actual_cost',
+    'actual_cost': 'monthly_actual_cost',
+    'earned_amount': 'monthly_earned_amount',
+}
 
 
 class ProjectFinancialAxisKpi(models.Model):
@@ -10,7 +31,8 @@ class ProjectFinancialAxisKpi(models.Model):
     @api.depends('axis_id', 'month_date')
     def _compute_display_name(self):
         for record in self:
-            record.display_name = f"{record.axis_id.name} - {record.month_date.strftime('%B %Y')}"
+            record.display_name = f"{record.axis_id.name} - {record.month_date.strftime('%B %Y')}" \
+                if record.month_date else record.axis_id.name
 
     display_name = fields.Char(string="Nom",  compute='_compute_display_name',  store=True)  
     axis_id = fields.Many2one('project.financial.axis',  string="Axe", required=True,  ondelete='cascade',index=True)  
@@ -31,9 +53,14 @@ class ProjectFinancialAxisKpi(models.Model):
                                             help="Valeur acquise pour le mois uniquement")
     monthly_actual_cost = fields.Monetary(string="CR Mensuel", currency_field='currency_id', digits=(16, 2),
                                           help="Coût réel pour le mois uniquement")
+    monthly_line_count = fields.Integer(string="Lignes du Mois", help="Nombre de lignes d'axe du mois")
     
     cost_performance_index = fields.Float(string="IPC", digits=(16, 4), help="Indice de performance des coûts: VA cumulé / CR cumulé")
     delay_performance_index = fields.Float(string="IPD", digits=(16, 4), help="Indice de performance des délais: VA cumulé / VP cumulé")
+    monthly_cost_performance_index = fields.Float(string="IPC Mensuel", digits=(16, 4),
+                                                  help="Indice de performance des coûts du mois: VA mensuel / CR mensuel")
+    monthly_delay_performance_index = fields.Float(string="IPD Mensuel", digits=(16, 4),
+                                                   help="Indice de performance des délais du mois: VA mensuel / budget de l'axe")
     currency_id = fields.Many2one('res.currency', related='axis_id.currency_id', store=True)
     
     cost_variance = fields.Monetary(
@@ -54,179 +81,468 @@ class ProjectFinancialAxisKpi(models.Model):
         help="SV = VA - VP (positif = en avance, négatif = en retard)"
     )
 
-    @api.depends('cumulative_earned_amount', 'cumulative_actual_cost', 
-                 'cumulative_planned_budget')
+    _sql_constraints = [
+        ('axis_month_uniq', 'UNIQUE(axis_id, month_date)',
+         'Un seul cumul par axe et par mois'),
+    ]
+
+    def init(self):
+        super().init()
+        # Cumuls antérieurs au comptage des lignes : complétés une seule fois
+        self.env.cr.execute("""
+            UPDATE project_financial_axis_kpi kpi
+            SET monthly_line_count = (
+                SELECT COUNT(*)
+                FROM project_financial_axis_line line
+                WHERE line.axis_id = kpi.axis_id
+                  AND line.date >= kpi.month_date
+                  AND line.date < kpi.month_date + interval '1 month'
+            )
+            WHERE kpi.monthly_line_count IS NULL
+        """)
+
+    @api.depends('cum_earned_amount', 'cum_actual_cost', 
+                 'cum_planned_budget')
     def _compute_variances(self):
         """Calcule les écarts (variances)"""
         for record in self:
             # Écarts absolus
-            record.cost_variance = record.cumulative_earned_amount - record.cumulative_actual_cost
-            record.schedule_variance = record.cumulative_earned_amount - record.cumulative_planned_budget
+            record.cost_variance = record.cum_earned_amount - record.cum_actual_cost
+            record.schedule_variance = record.cum_earned_amount - record.cum_planned_budget
 
     def compute_cums(self, month_date=None):
-        """Calcule ou recalcule les cumuls pour un mois donné"""
-        for record in self:
-            if month_date:
-                record.month_date = fields.Date.start_of(month_date, 'month')
-            
-            month_start = record.month_date
-            month_end = fields.Date.end_of(month_start, 'month')
-            
-            # Récupérer l'axe
-            axis = record.axis_id
-            
-            # 1. Budget planifié mensuel (depuis budget.line)
-            budget_lines = self.env['project.financial.axis.budget.line'].search([
-                ('axis_id', '=', axis.id),
-                ('date', '>=', month_start),
-                ('date', '<=', month_end)
-            ])
-            record.monthly_planned_budget = sum(budget_lines.mapped('planned_budget'))
-            
-            # 2. Valeur acquise mensuelle
-            axis_lines = self.env['project.financial.axis.line'].search([
-                ('axis_id', '=', axis.id),
-                ('date', '>=', month_start),
-                ('date', '<=', month_end)
-            ])
-            record.monthly_earned_amount = sum(axis_lines.mapped('earned_amount'))
-            record.monthly_actual_cost = sum(axis_lines.mapped('actual_cost'))
-            
-            # 3. Cumul jusqu'à ce mois
-            # Chercher tous les mois précédents
-            previous_months = self.search([
-                ('axis_id', '=', axis.id),
-                ('month_date', '<', month_start)
-            ], order='month_date asc')
-            
-            # Initialiser avec les valeurs du mois courant
-            cumul_vp = record.monthly_planned_budget
-            cumul_va = record.monthly_earned_amount
-            cumul_cr = record.monthly_actual_cost
-            
-            # Ajouter les cumuls des mois précédents
-            for prev_month in previous_months:
-                cumul_vp += prev_month.monthly_planned_budget
-                cumul_va += prev_month.monthly_earned_amount
-                cumul_cr += prev_month.monthly_actual_cost
-            
-            record.cum_planned_budget = cumul_vp
-            record.cum_earned_amount = cumul_va
-            record.cum_actual_cost = cumul_cr
-            
-            # 4. Calcul des indices
-            record.cost_performance_index = cumul_va / cumul_cr if cumul_cr != 0 else 0.0
-            record.delay_performance_index = cumul_va / cumul_vp if cumul_vp != 0 else 0.0
+        """Calcule ou recalcule les cumuls des axes de ces mois"""
+        self._recompute_axes(self.axis_id.ids)
 
     def compute_cumulatives(self):
         """Calcule ou recalcule les cumuls"""
-        for record in self:
-            if not record.axis_id or not record.month_date:
-                continue
-                
-            month_start = record.month_date
-            month_end = fields.Date.end_of(month_start, 'month')
-            axis = record.axis_id
-            
-            # 1. Budget planifié mensuel (depuis budget.line)
-            budget_lines = self.env['project.financial.axis.budget.line'].search([
-                ('axis_id', '=', axis.id),
-                ('date', '>=', month_start),
-                ('date', '<=', month_end)
-            ])
-            record.monthly_planned_budget = sum(budget_lines.mapped('planned_budget'))
-            
-            # 2. Valeur acquise mensuelle
-            axis_lines = self.env['project.financial.axis.line'].search([
-                ('axis_id', '=', axis.id),
-                ('date', '>=', month_start),
-                ('date', '<=', month_end)
-            ])
-            record.monthly_earned_amount = sum(axis_lines.mapped('earned_amount'))
-            record.monthly_actual_cost = sum(axis_lines.mapped('actual_cost'))
-            
-            # 3. Cumul jusqu'à ce mois (tous les mois précédents + mois courant)
-            # Chercher tous les mois précédents ou égaux
-            all_previous_months = self.search([
-                ('axis_id', '=', axis.id),
-                ('month_date', '<=', month_start)
-            ], order='month_date asc')
-            
-            # Réinitialiser les cumuls
-            cumul_vp = 0
-            cumul_va = 0
-            cumul_cr = 0
-            
-            # Somme de tous les mois jusqu'à celui-ci
-            for month in all_previous_months:
-                if month.id != record.id:  # Éviter de compter l'enregistrement actuel si pas encore calculé
-                    cumul_vp += month.monthly_planned_budget
-                    cumul_va += month.monthly_earned_amount
-                    cumul_cr += month.monthly_actual_cost
-            
-            # Ajouter les valeurs du mois courant
-            cumul_vp += record.monthly_planned_budget
-            cumul_va += record.monthly_earned_amount
-            cumul_cr += record.monthly_actual_cost
-            
-            # Sauvegarder les cumuls
-            record.cumulative_planned_budget = cumul_vp
-            record.cumulative_earned_amount = cumul_va
-            record.cumulative_actual_cost = cumul_cr
-            
-            # 4. Calcul des indices
-            record.cost_performance_index = cumul_va / cumul_cr if cumul_cr != 0 else 0.0
-            record.schedule_performance_index = cumul_va / cumul_vp if cumul_vp != 0 else 0.0
+        self._recompute_axes(self.axis_id.ids)
     
     @api.model
     def cron_compute_monthly_cums(self):
-        """Cron pour calculer automatiquement les cumuls mensuels"""
-        # Récupérer tous les axes actifs
-        axes = self.env['project.financial.axis'].search([('active', '=', True)])
+        """
+        Cron pour calculer automatiquement les cumuls mensuels du portefeuille
+        Une société par lot : deux requêtes groupées et un upsert, validés
+        (commit) avec leur point de contrôle ; la tâche se replanifie avant
+        d'atteindre la limite du worker
+        """
+        start = time.time()
+        budget = self.env['stock.move']._get_resync_time_budget()
+        state = self._get_portfolio_state()
+        if not state.get('company_ids'):
+            self.env.cr.execute("""
+                SELECT DISTINCT pp.company_id
+                FROM project_financial_axis axis
+                JOIN project_financial_progress pfp ON pfp.id = axis.project_financial_id
+                JOIN project_project pp ON pp.id = pfp.project_id
+                WHERE axis.active AND pp.company_id IS NOT NULL
+                ORDER BY pp.company_id
+            """)
+            state = {'company_ids': [row[0] for row in self.env.cr.fetchall()], 'done': 0}
         
-        for axis in axes:
-            start_date = axis.project_financial_id.date_start or fields.Date.today()
-            end_date = axis.project_financial_id.date_end or fields.Date.today()
+        while state['company_ids']:
+            company_id = state['company_ids'][0]
+            count = self._recompute_company_cums(company_id)
             
-            current_month = fields.Date.start_of(start_date, 'month')
-            end_month = fields.Date.start_of(end_date, 'month')
+            state['company_ids'].pop(0)
+            state['done'] += count
+            self._set_portfolio_state(state)
+            self.env.cr.commit()
+            self.env['ir.cron']._notify_progress(done=1, remaining=len(state['company_ids']))
             
-            while current_month <= end_month:
-                monthly_record = self.search([
-                    ('axis_id', '=', axis.id),
-                    ('month_date', '=', current_month)
-                ], limit=1)
-                
-                if not monthly_record:
-                    monthly_record = self.create({
-                        'axis_id': axis.id,
-                        'month_date': current_month,
-                    })
-                
-                # Calculer les cumuls
-                monthly_record.compute_cumulatives()
-                current_month = fields.Date.add(current_month, months=1)
-    
-    # AJOUTER UNE MÉTHODE POUR RÉAGIR AUX CHANGEMENTS
-    def _invalidate_and_recompute(self):
-        """Invalide et recalcule les cumuls quand les données sources changent"""
-        # Marquer tous les cumuls de cet axe comme à recalculer
-        # On pourrait utiliser un champ 'needs_recomputation'
-        pass
+            if state['company_ids'] and time.time() - start > budget:
+                _logger.info("Cumuls portefeuille: limite de temps atteinte, replanification")
+                self.env.ref('somachame_finance.ir_cron_compute_monthly_cums')._trigger()
+                return
+        
+        _logger.info(f"=== Fin cumuls portefeuille: {state['done']} axes ===")
+        self._set_portfolio_state({})
+        self.env['project.financial.progress']._cron_compute_evm_forecasts()
+
+    @api.model
+    def _recompute_company_cums(self, company_id):
+        """Recalcule en un passage les cumuls de tous les axes actifs d'une société"""
+        self.env.cr.execute("""
+            SELECT axis.id
+            FROM project_financial_axis axis
+            JOIN project_financial_progress pfp ON pfp.id = axis.project_financial_id
+            JOIN project_project pp ON pp.id = pfp.project_id
+            WHERE axis.active AND pp.company_id = %s
+        """, [company_id])
+        axis_ids = [row[0] for row in self.env.cr.fetchall()]
+        self._recompute_axes(axis_ids)
+        _logger.info(f"Cumuls portefeuille: société {company_id}, {len(axis_ids)} axes")
+        return len(axis_ids)
+
+    @api.model
+    def _get_portfolio_state(self):
+        value = self.env['ir.config_parameter'].sudo().get_param(PORTFOLIO_STATE_PARAM)
+        return json.loads(value) if value else {}
+
+    @api.model
+    def _set_portfolio_state(self, state):
+        self.env['ir.config_parameter'].sudo().set_param(PORTFOLIO_STATE_PARAM, json.dumps(state) if state else False)
 
     def recompute_all_for_axis(self, axis_id):
         """Recalcule tous les cumuls pour un axe spécifique"""
-        axis = self.env['project.financial.axis'].browse(axis_id)
-        if not axis.exists():
+        self._recompute_axes([axis_id])
+
+    # ===== MOTEUR DE CUMULS =====
+
+    @api.model
+    def _read_monthly_totals(self, first_months):
+        """
+        Totaux mensuels VP, VA, CR des axes, en deux requêtes groupées
+        first_months: {axis_id: mois} lecture à partir de ce mois (None : tout l'axe)
+        Retourne {axis_id: {mois: [vp, va, cr, nombre de lignes]}}
+        """
+        self.env.flush_all()
+        totals = defaultdict(lambda: defaultdict(lambda: [0.0, 0.0, 0.0, 0]))
+        bounds = ', '.join(['%s'] * len(first_months))
+        params = [(axis_id, month) for axis_id, month in first_months.items()]
+        
+        self.env.cr.execute(f"""
+            SELECT line.axis_id, date_trunc('month', line.date)::date, SUM(line.planned_budget)
+            FROM project_financial_axis_budget_line line
+            JOIN (VALUES {bounds}) AS v(axis_id, first_month)
+              ON line.axis_id = v.axis_id
+             AND (v.first_month IS NULL OR line.date >= v.first_month::date)
+            GROUP BY line.axis_id, date_trunc('month', line.date)
+        """, params)
+        for axis_id, month, planned in self.env.cr.fetchall():
+            totals[axis_id][month][0] = planned or 0.0
+        
+        self.env.cr.execute(f"""
+            SELECT line.axis_id, date_trunc('month', line.date)::date,
+                   SUM(line.earned_amount), SUM(line.actual_cost), COUNT(*)
+            FROM project_financial_axis_line line
+            JOIN (VALUES {bounds}) AS v(axis_id, first_month)
+              ON line.axis_id = v.axis_id
+             AND (v.first_month IS NULL OR line.date >= v.first_month::date)
+            GROUP BY line.axis_id, date_trunc('month', line.date)
+        """, params)
+        for axis_id, month, earned, cost, count in self.env.cr.fetchall():
+            totals[axis_id][month][1] = earned or 0.0
+            totals[axis_id][month][2] = cost or 0.0
+            totals[axis_id][month][3] = count
+        
+        return totals
+
+    @api.model
+    def _read_rollup_seeds(self, first_months):
+        """
+        Dernier cumul stocké avant le mois de départ de chaque axe
+        Retourne {axis_id: (mois, cum_vp, cum_va, cum_cr)}
+        """
+        if not first_months:
+            return {}
+        self.env.cr.execute(f"""
+            SELECT DISTINCT ON (kpi.axis_id)
+                   kpi.axis_id, kpi.month_date,
+                   kpi.cum_planned_budget, kpi.cum_earned_amount, kpi.cum_actual_cost
+            FROM project_financial_axis_kpi kpi
+            JOIN (VALUES {', '.join(['%s'] * len(first_months))}) AS v(axis_id, first_month)
+              ON kpi.axis_id = v.axis_id AND kpi.month_date < v.first_month::date
+            ORDER BY kpi.axis_id, kpi.month_date DESC
+        """, list(first_months.items()))
+        return {
+            axis_id: (month, cum_vp or 0.0, cum_va or 0.0, cum_cr or 0.0)
+            for axis_id, month, cum_vp, cum_va, cum_cr in self.env.cr.fetchall()
+        }
+
+    @api.model
+    def _read_axis_spans(self, axis_ids):
+        """
+        Période des axes d'après les dates de leur projet (date_from/date_to)
+        jusqu'au mois courant au plus tard
+        Retourne {axis_id: (premier mois, dernier mois)}
+        """
+        today_month = fields.Date.start_of(fields.Date.today(), 'month')
+        self.env.cr.execute("""
+            SELECT axis.id, pp.date_start, pp.date
+            FROM project_financial_axis axis
+            JOIN project_financial_progress pfp ON pfp.id = axis.project_financial_id
+            JOIN project_project pp ON pp.id = pfp.project_id
+            WHERE axis.id IN %s
+        """, [tuple(axis_ids)])
+        return {
+            axis_id: (
+                date_from and min(fields.Date.start_of(date_from, 'month'), today_month),
+                min(fields.Date.start_of(date_to, 'month'), today_month) if date_to else today_month,
+            )
+            for axis_id, date_from, date_to in self.env.cr.fetchall()
+        }
+
+    @api.model
+    def _compute_rollup_rows(self, monthly, seed=None, first_month=None, last_month=None):
+        """
+        Cumuls d'un axe par somme glissante sur ses mois triés
+        Les mois sans mouvement entre le premier et le dernier sont comblés
+        seed: cumuls (cum_vp, cum_va, cum_cr) du mois précédant first_month
+        last_month: prolonge la série jusqu'à ce mois
+        monthly: {mois: (vp, va, cr, nombre de lignes)}
+        Retourne [(mois, vp, va, cr, cum_vp, cum_va, cum_cr, nombre de lignes)]
+        """
+        months = sorted(monthly)
+        month = first_month or (months[0] if months else None)
+        last = max(filter(None, [months[-1] if months else None, last_month]), default=None)
+        if not month or not last:
+            return []
+        
+        cum_vp, cum_va, cum_cr = seed or (0.0, 0.0, 0.0)
+        rows = []
+        while month <= last:
+            vp, va, cr, count = monthly.get(month, (0.0, 0.0, 0.0, 0))
+            cum_vp += vp
+            cum_va += va
+            cum_cr += cr
+            rows.append((month, vp, va, cr, cum_vp, cum_va, cum_cr, count))
+            month = fields.Date.add(month, months=1)
+        return rows
+
+    @api.model
+    def _mark_cumulatives_dirty(self, keys):
+        """
+        Retient le premier mois touché par axe pendant la transaction
+        keys: couples (axis_id, date), date None pour tout l'axe
+        Les écritures ORM comme les écritures SQL en masse (synchronisations,
+        imports) alimentent ce registre : le recalcul a lieu une seule fois,
+        avant le commit, en un passage groupé sur tous les axes touchés
+        """
+        dirty = self.env.cr.precommit.data.setdefault('somachame_finance.kpi_months', {})
+        was_empty = not dirty
+        for axis_id, date in keys:
+            if not axis_id:
+                continue
+            # Sans date, l'axe est recalculé en entier
+            month = date and fields.Date.start_of(fields.Date.to_date(date), 'month')
+            if axis_id in dirty and (dirty[axis_id] is None or (month and month >= dirty[axis_id])):
+                continue
+            dirty[axis_id] = month
+        if was_empty and dirty:
+            self.env.cr.precommit.add(self._flush_dirty_cumulatives)
+
+    @api.model
+    def _flush_dirty_cumulatives(self):
+        dirty = self.env.cr.precommit.data.pop('somachame_finance.kpi_months', {})
+        axis_ids = self.env['project.financial.axis'].browse(list(dirty)).exists().ids
+        if axis_ids:
+            self._recompute_axes_from({axis_id: dirty[axis_id] for axis_id in axis_ids})
+
+    @api.model
+    def _recompute_axes(self, axis_ids):
+        """Recalcule tous les cumuls mensuels des axes"""
+        self._recompute_axes_from(dict.fromkeys(axis_ids))
+
+    @api.model
+    def _recompute_axes_from(self, first_months):
+        """
+        Recalcule les cumuls mensuels des axes à partir d'un mois
+        Le cumul stocké du mois précédent sert de point de départ ; sans
+        cumul antérieur, l'axe est recalculé en entier
+        first_months: {axis_id: premier mois touché (None : tout l'axe)}
+        Une lecture groupée, une passe de sommes glissantes, un upsert
+        """
+        if not first_months:
             return
         
-        # Récupérer tous les cumuls pour cet axe
-        monthly_records = self.search([('axis_id', '=', axis.id)])
+        first_months = {
+            axis_id: month and fields.Date.start_of(month, 'month')
+            for axis_id, month in first_months.items()
+        }
+        seeds = self._read_rollup_seeds({a: m for a, m in first_months.items() if m})
         
-        # Les recalculer dans l'ordre chronologique
-        for record in monthly_records.sorted('month_date'):
-            record.compute_cumulatives()
-    
+        # Reprise au mois suivant le dernier cumul stocké
+        starts = {}
+        for axis_id, month in first_months.items():
+            seed = seeds.get(axis_id) if month else None
+            starts[axis_id] = fields.Date.add(seed[0], months=1) if seed else None
+        
+        totals = self._read_monthly_totals(starts)
+        spans = self._read_axis_spans(list(starts))
+        rows_by_axis = {}
+        for axis_id, start in starts.items():
+            monthly = totals.get(axis_id, {})
+            span_first, span_last = spans.get(axis_id, (None, None))
+            first = start or min(filter(None, [span_first, min(monthly, default=None)]), default=None)
+            rows_by_axis[axis_id] = self._compute_rollup_rows(
+                monthly,
+                seed=seeds[axis_id][1:] if start else None,
+                first_month=first,
+                last_month=span_last,
+            )
+        self._write_rollup(rows_by_axis, starts)
+        _logger.info(
+            f"Cumuls KPI: {sum(len(rows) for rows in rows_by_axis.values())} mois pour {len(starts)} axes "
+            f"({sum(1 for start in starts.values() if start)} en reprise)"
+        )
+
+    @api.model
+    def _write_rollup(self, rows_by_axis, starts=None):
+        """
+        Écrit en masse les cumuls calculés et supprime les mois hors période
+        rows_by_axis: {axis_id: [(mois, vp, va, cr, cum_vp, cum_va, cum_cr, nombre de lignes)]}
+        starts: {axis_id: mois} les cumuls antérieurs à ce mois sont conservés
+        """
+        starts = starts or {}
+        axis_names = {
+            axis['id']: axis['name']
+            for axis in self.env['project.financial.axis'].search_read(
+                [('id', 'in', list(rows_by_axis))], ['name'])
+        }
+        
+        values = []
+        bounds = []
+        for axis_id, rows in rows_by_axis.items():
+            start = starts.get(axis_id)
+            bounds.append((axis_id, start or (rows[0][0] if rows else None), rows[-1][0] if rows else None, bool(start)))
+            for month, vp, va, cr, cum_vp, cum_va, cum_cr, count in rows:
+                values.append((
+                    axis_id, month, f"{axis_names.get(axis_id, '')} - {month.strftime('%B %Y')}",
+                    vp, va, cr, count, cum_vp, cum_va, cum_cr,
+                    cum_va / cum_cr if cum_cr else 0.0,
+                    cum_va / cum_vp if cum_vp else 0.0,
+                    cum_va - cum_cr,
+                    cum_va - cum_vp,
+                ))
+        
+        # Mois devenus sans objet : hors de la période calculée de l'axe,
+        # sauf les mois antérieurs au départ d'une reprise
+        for chunk in split_every(1000, bounds):
+            self.env.cr.execute(f"""
+                DELETE FROM project_financial_axis_kpi kpi
+                USING (VALUES {', '.join(['%s'] * len(chunk))}) AS v(axis_id, first_month, last_month, is_forward)
+                WHERE kpi.axis_id = v.axis_id
+                  AND CASE WHEN v.is_forward
+                           THEN kpi.month_date >= v.first_month::date
+                                AND (v.last_month IS NULL OR kpi.month_date > v.last_month::date)
+                           ELSE v.last_month IS NULL
+                                OR kpi.month_date < v.first_month::date
+                                OR kpi.month_date > v.last_month::date
+                      END
+            """, chunk)
+        
+        for chunk in split_every(1000, values):
+            self.env.cr.execute(f"""
+                INSERT INTO project_financial_axis_kpi AS kpi
+                    (axis_id, project_financial_id, currency_id, month_date, display_name,
+                     monthly_planned_budget, monthly_earned_amount, monthly_actual_cost, monthly_line_count,
+                     cum_planned_budget, cum_earned_amount, cum_actual_cost,
+                     cost_performance_index, delay_performance_index,
+                     monthly_cost_performance_index, monthly_delay_performance_index,
+                     cost_variance, schedule_variance,
+                     create_uid, create_date, write_uid, write_date)
+                SELECT axis.id, axis.project_financial_id, axis.currency_id, v.month_date::date, v.display_name,
+                       v.vp, v.va, v.cr, v.line_count, v.cum_vp, v.cum_va, v.cum_cr, v.cpi, v.spi,
+                       COALESCE(v.va / NULLIF(v.cr, 0), 0),
+                       COALESCE(v.va / NULLIF(axis.planned_budget, 0), 0),
+                       v.cv, v.sv,
+                       %s, now() at time zone 'UTC', %s, now() at time zone 'UTC'
+                FROM (VALUES {', '.join(['%s'] * len(chunk))})
+                    AS v(axis_id, month_date, display_name, vp, va, cr, line_count, cum_vp, cum_va, cum_cr, cpi, spi, cv, sv)
+                JOIN project_financial_axis axis ON axis.id = v.axis_id
+                ON CONFLICT (axis_id, month_date) DO UPDATE
+                SET display_name = EXCLUDED.display_name,
+                    monthly_planned_budget = EXCLUDED.monthly_planned_budget,
+                    monthly_earned_amount = EXCLUDED.monthly_earned_amount,
+                    monthly_actual_cost = EXCLUDED.monthly_actual_cost,
+                    monthly_line_count = EXCLUDED.monthly_line_count,
+                    cum_planned_budget = EXCLUDED.cum_planned_budget,
+                    cum_earned_amount = EXCLUDED.cum_earned_amount,
+                    cum_actual_cost = EXCLUDED.cum_actual_cost,
+                    cost_performance_index = EXCLUDED.cost_performance_index,
+                    delay_performance_index = EXCLUDED.delay_performance_index,
+                    monthly_cost_performance_index = EXCLUDED.monthly_cost_performance_index,
+                    monthly_delay_performance_index = EXCLUDED.monthly_delay_performance_index,
+                    cost_variance = EXCLUDED.cost_variance,
+                    schedule_variance = EXCLUDED.schedule_variance,
+                    write_uid = EXCLUDED.write_uid,
+                    write_date = EXCLUDED.write_date
+            """, [self.env.uid, self.env.uid, *chunk])
+        
+        self.env['project.financial.axis.kpi'].invalidate_model()
+        self._bump_grid_versions(list(rows_by_axis))
+
+    @api.model
+    def _bump_grid_versions(self, axis_ids):
+        """
+        Incrémente la version des grilles des axes dont les cumuls sont réécrits,
+        dans la même transaction : elle devient visible au commit, avec eux
+        Seules les transactions qui réécrivent les mêmes axes se sérialisent
+        """
+        if not axis_ids:
+            return
+        self.env.cr.execute("""
+            UPDATE project_financial_axis
+            SET kpi_grid_version = COALESCE(kpi_grid_version, 0) + 1
+            WHERE id = ANY(%s)
+        """, [list(axis_ids)])
+        self.env['project.financial.axis'].invalidate_model(['kpi_grid_version'])
+        self.env.cr.precommit.data['somachame_finance.kpi_grid_bumped'] = True
+
+    # ===== COURBES EN S =====
+
+    @api.model
+    def _get_scurve_domain(self, project_financial_id=None, axis_ids=None):
+        """Filtre SQL des cumuls d'un projet ou d'une liste d'axes (droits vérifiés)"""
+        if axis_ids:
+            axes = self.env['project.financial.axis'].browse(axis_ids).exists()
+            axes.check_access('read')
+            return "kpi.axis_id IN %s", [tuple(axes.ids) or (0,)]
+        project = self.env['project.financial.progress'].browse(project_financial_id).exists()
+        project.check_access('read')
+        return "kpi.project_financial_id = %s", [project.id or 0]
+
+    @api.model
+    def get_scurve_etag(self, project_financial_id=None, axis_ids=None):
+        """Empreinte des cumuls de la sélection : change à chaque recalcul"""
+        where, params = self._get_scurve_domain(project_financial_id, axis_ids)
+        self.env.flush_all()
+        self.env.cr.execute(f"""
+            SELECT COUNT(*), MAX(kpi.write_date)
+            FROM project_financial_axis_kpi kpi
+            WHERE {where}
+        """, params)
+        count, write_date = self.env.cr.fetchone()
+        key = f"{project_financial_id}|{sorted(axis_ids or [])}|{count}|{write_date}"
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    @api.model
+    def get_scurve_data(self, project_financial_id=None, axis_ids=None):
+        """
+        Courbes en S d'un projet ou d'une liste d'axes depuis les cumuls mensuels
+        Les montants mensuels des axes sont sommés par mois en une requête,
+        puis cumulés sur une série de mois continue
+        Retourne {'labels': [AAAA-MM], 'vp', 'va', 'cr', 'cpi', 'spi': [...], 'etag'}
+        """
+        where, params = self._get_scurve_domain(project_financial_id, axis_ids)
+        self.env.flush_all()
+        self.env.cr.execute(f"""
+            SELECT kpi.month_date,
+                   SUM(kpi.monthly_planned_budget),
+                   SUM(kpi.monthly_earned_amount),
+                   SUM(kpi.monthly_actual_cost),
+                   SUM(kpi.monthly_line_count)
+            FROM project_financial_axis_kpi kpi
+            WHERE {where}
+            GROUP BY kpi.month_date
+        """, params)
+        monthly = {
+            month: (vp or 0.0, va or 0.0, cr or 0.0, count or 0)
+            for month, vp, va, cr, count in self.env.cr.fetchall()
+        }
+        
+        data = {'labels': [], 'vp': [], 'va': [], 'cr': [], 'cpi': [], 'spi': []}
+        for month, _vp, _va, _cr, cum_vp, cum_va, cum_cr, _count in self._compute_rollup_rows(monthly):
+            data['labels'].append(month.strftime('%Y-%m'))
+            data['vp'].append(round(cum_vp, 2))
+            data['va'].append(round(cum_va, 2))
+            data['cr'].append(round(cum_cr, 2))
+            data['cpi'].append(round(cum_va / cum_cr, 4) if cum_cr else 0.0)
+            data['spi'].append(round(cum_va / cum_vp, 4) if cum_vp else 0.0)
+        data['etag'] = self.get_scurve_etag(project_financial_id, axis_ids)
+        return data
+
     # ACTION DANS L'INTERFACE
     def action_recompute(self):
         """Action pour recalculer manuellement"""
@@ -282,50 +598,221 @@ class ProjectFinancialAxisKpi(models.Model):
 
 class ProjectFinancialAxisLine(models.Model):
     _inherit = "project.financial.axis.line"
+
+    # Champs dont la modification touche les cumuls
+    _CUMULATIVE_FIELDS = ['earned_value', 'acquise_value', 'actual_cost', 'grid_cost', 'date', 'axis_id']
     
     def write(self, vals):
+        tracked = any(field in vals for field in self._CUMULATIVE_FIELDS)
+        if tracked:
+            # L'ancien mois (ou l'ancien axe) est aussi touché
+            self._trigger_cumulative_recomputation()
+        
         result = super().write(vals)
         
-        # Si earned_amount ou actual_cost change, déclencher le recalcul des cumuls
-        if any(field in vals for field in ['earned_amount', 'actual_cost', 'date']):
+        # Si la valeur acquise ou le coût change, déclencher le recalcul des cumuls
+        if tracked:
             self._trigger_cumulative_recomputation()
         
         return result
     
-    @api.model
-    def create(self, vals):
-        record = super().create(vals)
-        record._trigger_cumulative_recomputation()
-        return record
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        records._trigger_cumulative_recomputation()
+        return records
     
-    # def unlink(self):
-    #     # Récupérer les axes concernés avant suppression
-    #     axes_to_recompute = self.mapped('axis_id')
-    #     result = super().unlink()
-        
-    #     # Déclencher le recalcul
-    #     if axes_to_recompute:
-    #         for axis in axes_to_recompute:
-    #             self.env['project.financial.axis.monthly.cumulative'].recompute_all_for_axis(axis.id)
-        
-    #     return result
+    def unlink(self):
+        self._trigger_cumulative_recomputation()
+        return super().unlink()
     
     def _trigger_cumulative_recomputation(self):
-        """Déclenche le recalcul des cumuls pour les axes concernés"""
-        axes = self.mapped('axis_id')
-        if axes:
-            for axis in axes:
-                # Recalcul asynchrone mais sans queue_job
-                # On pourrait utiliser un flag et un cron, mais ici on recalcule directement
-                self.env['project.financial.axis.monthly.cumulative'].recompute_all_for_axis(axis.id, self.date)
+        """Marque les mois des lignes à recalculer en fin de transaction"""
+        self.env['project.financial.axis.kpi']._mark_cumulatives_dirty(
+            (line.axis_id.id, line.date) for line in self
+        )
+
+    # ===== GRILLES MENSUELLES =====
+
+    @api.model
+    def read_group(self, domain, fields, groupby, offset=0, limit=None, orderby=False, lazy=True):
+        """
+        Les grilles axe × mois sont servies par les cumuls mensuels (une
+        requête, noms et couleurs des axes compris) au lieu de regrouper
+        toutes les lignes ; les autres regroupements passent par le standard
+        """
+        key = self._get_grid_rollup_key(domain, fields, groupby, offset, limit, lazy)
+        if key is None:
+            return super().read_group(domain, fields, groupby, offset=offset, limit=limit,
+                                      orderby=orderby, lazy=lazy)
+        return self._read_grid_from_rollup(domain, key)
+
+    @api.model
+    def _get_grid_rollup_key(self, domain, field_specs, groupby, offset, limit, lazy):
+        """
+        Clé (mesures, axes, projets, début, fin exclue) si la demande peut être
+        servie par les cumuls mensuels, sinon None
+        Seuls les filtres sur l'axe, le projet et des bornes de mois entiers
+        sont reconnus ; les règles d'accès imposent le regroupement standard
+        """
+        groupby = [groupby] if isinstance(groupby, str) else list(groupby or [])
+        if lazy or offset or limit or sorted(groupby) != ['axis_id', 'date:month']:
+            return None
+        
+        measures = []
+        for spec in field_specs:
+            fname, _sep, aggregate = spec.partition(':')
+            if fname in ('axis_id', 'date', '__count'):
+                continue
+            if fname not in GRID_ROLLUP_MEASURES or aggregate not in ('', 'sum'):
+                return None
+            measures.append(fname)
+        if not measures:
+            return None
+        
+        self.check_access('read')
+        if self.env['ir.rule']._compute_domain(self._name, 'read'):
+            return None
+        
+        axis_ids = project_ids = date_from = date_to = None
+        for leaf in expression.normalize_domain(domain or []):
+            if leaf == '&' or leaf == expression.TRUE_LEAF:
+                continue
+            if not isinstance(leaf, (list, tuple)) or len(leaf) != 3:
+                return None
+            fname, operator, value = leaf
+            if fname in ('axis_id', 'project_financial_id') and operator in ('=', 'in'):
+                ids = tuple(sorted(value if isinstance(value, (list, tuple)) else [value]))
+                if not ids or not all(isinstance(id_, int) for id_ in ids):
+                    return None
+                if fname == 'axis_id':
+                    axis_ids = ids
+                else:
+                    project_ids = ids
+            elif fname == 'date' and operator in ('>=', '<', '<='):
+                date = fields.Date.to_date(value)
+                if operator == '<=':
+                    if date != fields.Date.end_of(date, 'month'):
+                        return None
+                    date = fields.Date.add(date, days=1)
+                elif date.day != 1:
+                    return None
+                if operator == '>=':
+                    date_from = date
+                else:
+                    date_to = date
+            else:
+                return None
+        return tuple(measures), axis_ids, project_ids, date_from, date_to
+
+    @api.model
+    def _get_grid_version(self, key):
+        """
+        Empreinte des versions validées des axes couverts par la grille,
+        None si la transaction courante a réécrit des cumuls : ses cellules
+        non validées ne doivent pas entrer en cache
+        Les cumuls en attente ne sont pas recalculés ici ; ils le sont au commit
+        """
+        if self.env.cr.precommit.data.get('somachame_finance.kpi_grid_bumped'):
+            return None
+        _measures, axis_ids, project_ids, _date_from, _date_to = key
+        self.env.cr.execute("""
+            SELECT md5(COALESCE(string_agg(id || ':' || COALESCE(kpi_grid_version, 0), ',' ORDER BY id), ''))
+            FROM project_financial_axis
+            WHERE (%s::int[] IS NULL OR id = ANY(%s::int[]))
+              AND (%s::int[] IS NULL OR project_financial_id = ANY(%s::int[]))
+        """, [
+            axis_ids and list(axis_ids), axis_ids and list(axis_ids),
+            project_ids and list(project_ids), project_ids and list(project_ids),
+        ])
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    @ormcache('version', 'lang', 'key')
+    def _read_grid_cells(self, version, lang, key):
+        """
+        Cellules d'une grille mises en cache par versions des axes couverts,
+        langue et clé de la grille
+        """
+        return self._query_grid_cells(lang, key)
+
+    @api.model
+    def _query_grid_cells(self, lang, key):
+        """Cellules (axe, nom, couleur, mois, lignes, mesures...) d'une grille, en une requête"""
+        measures, axis_ids, project_ids, date_from, date_to = key
+        columns = ', '.join(f"kpi.{GRID_ROLLUP_MEASURES[fname]}" for fname in measures)
+        self.env.cr.execute(f"""
+            SELECT kpi.axis_id, COALESCE(axis.name->>%s, axis.name->>'en_US'), axis.color,
+                   kpi.month_date, kpi.monthly_line_count, {columns}
+            FROM project_financial_axis_kpi kpi
+            JOIN project_financial_axis axis ON axis.id = kpi.axis_id
+            WHERE kpi.monthly_line_count > 0
+              AND (%s::int[] IS NULL OR kpi.axis_id = ANY(%s::int[]))
+              AND (%s::int[] IS NULL OR kpi.project_financial_id = ANY(%s::int[]))
+              AND (%s::date IS NULL OR kpi.month_date >= %s::date)
+              AND (%s::date IS NULL OR kpi.month_date < %s::date)
+            ORDER BY axis.sequence, axis.id, kpi.month_date
+        """, [
+            lang,
+            axis_ids and list(axis_ids), axis_ids and list(axis_ids),
+            project_ids and list(project_ids), project_ids and list(project_ids),
+            date_from, date_from, date_to, date_to,
+        ])
+        # Les mois comblés sans ligne ne forment pas de groupe
+        return tuple(self.env.cr.fetchall())
+
+    @api.model
+    def _read_grid_from_rollup(self, domain, key):
+        """Résultat au format read_group (non paresseux) à partir des cellules en cache"""
+        lang = get_lang(self.env)
+        version = self._get_grid_version(key)
+        if version is None:
+            cells = self._query_grid_cells(lang.code, key)
+        else:
+            cells = self._read_grid_cells(version, lang.code, key)
+        measures = key[0]
+        result = []
+        for axis_id, axis_name, color, month, count, *values in cells:
+            next_month = fields.Date.add(month, months=1)
+            group = {
+                'axis_id': (axis_id, axis_name),
+                'date:month': format_date(month, format=READ_GROUP_DISPLAY_FORMAT['month'], locale=lang.code),
+                '__count': count,
+                '__range': {'date:month': {'from': fields.Date.to_string(month),
+                                           'to': fields.Date.to_string(next_month)}},
+                '__domain': expression.AND([domain or [], [
+                    ('axis_id', '=', axis_id), ('date', '>=', month), ('date', '<', next_month),
+                ]]),
+                'color_index': color or 0,
+            }
+            group.update(zip(measures, values))
+            result.append(group)
+        return result
+
+class ProjectFinancialAxis(models.Model):
+    _inherit = "project.financial.axis"
+
+    kpi_grid_version = fields.Integer(string="Version des Grilles", default=0, readonly=True, copy=False,
+                                      help="Incrémentée à chaque réécriture des cumuls de l'axe")
+
+    def write(self, vals):
+        result = super().write(vals)
+        # Noms, couleurs et ordre des axes sont servis avec les grilles en cache
+        if any(field in vals for field in ['name', 'color', 'sequence']):
+            self.env['project.financial.axis.kpi']._bump_grid_versions(self.ids)
+        return result
 
 class ProjectFinancialAxisBudgetLine(models.Model):
     _inherit = "project.financial.axis.budget.line"
 
     def write(self, vals):
+        tracked = any(field in vals for field in ['planned_budget', 'date', 'axis_id'])
+        if tracked:
+            self._trigger_cumulative_recomputation()
+        
         result = super().write(vals)
         
-        if 'planned_budget' in vals or 'date' in vals:
+        if tracked:
             self._trigger_cumulative_recomputation()
         
         return result
@@ -337,43 +824,19 @@ class ProjectFinancialAxisBudgetLine(models.Model):
         return record
     
     def unlink(self):
-        axes_to_recompute = self.mapped('axis_id')
-        result = super().unlink()
-        
-        if axes_to_recompute:
-            for axis in axes_to_recompute:
-                self.env['project.financial.axis.monthly.cumulative'].recompute_all_for_axis(axis.id)
-        
-        return result
+        self._trigger_cumulative_recomputation()
+        return super().unlink()
     
     def _trigger_cumulative_recomputation(self):
-        """Déclenche le recalcul des cumuls pour les axes concernés"""
-        axes = self.mapped('axis_id')
-        if axes:
-            for axis in axes:
-                self.env['project.financial.axis.monthly.cumulative'].recompute_all_for_axis(axis.id, self.date)
-    
-    # def write(self, vals):
-    #     result = super().write(vals)
-        
-    #     if 'planned_budget' in vals or 'date' in vals:
-    #         self._trigger_cumulative_recomputation()
-        
-    #     return result
-    
-    # @api.model_create_multi
-    # def create(self, vals_list):
-    #     records = super().create(vals_list)
-    #     records._trigger_cumulative_recomputation()
-    #     return records
-    
-    # def _trigger_cumulative_recomputation(self):
-    #     """Déclenche le recalcul des cumuls pour les axes concernés"""
-    #     axes = self.mapped('axis_id')
-    #     if axes:
-    #         # Recalculer les cumuls pour ces axes
-    #         monthly_records = self.env['project.financial.axis.kpi'].search([
-    #             ('axis_id', 'in', axes.ids)
-    #         ])
-    #         for record in monthly_records:
-    #             record.compute_cumulatives()
+        """Marque les mois des lignes à recalculer en fin de transaction"""
+        self.env['project.financial.axis.kpi']._mark_cumulatives_dirty(
+            (line.axis_id.id, line.date) for line in self
+        )
+
+class ProjectFinancialProgress(models.Model):
+    _inherit = "project.financial.progress"
+
+    def _trigger_cumulative_recomputation(self):
+        """Marque tous les axes des projets à recalculer en fin de transaction"""
+        axes = self.env['project.financial.axis'].search([('project_financial_id', 'in', self.ids)])
+        self.env['project.financial.axis.kpi']._mark_cumulatives_dirty((axis_id, None) for axis_id in axes.ids)
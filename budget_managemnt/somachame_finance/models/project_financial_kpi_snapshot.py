@@ -0,0 +1,89 @@
+import logging
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+
+class ProjectFinancialKpiSnapshot(models.Model):
+    """
+    Photographie des cumuls KPI à la clôture d'un mois
+    Une ligne par (projet, mois), les axes étant regroupés dans une colonne JSON ;
+    les lignes ne sont jamais modifiées après leur création
+    """
+    _name = "project.financial.kpi.snapshot"
+    _description = "Clôture mensuelle des indicateurs"
+    _order = "month_date desc, project_financial_id"
+
+    project_financial_id = fields.Many2one('project.financial.progress', string="Projet Financier",
+                                           required=True, readonly=True, index=True, ondelete='cascade')
+    month_date = fields.Date(string="Mois", required=True, readonly=True, index=True)
+    currency_id = fields.Many2one('res.currency', related='project_financial_id.currency_id')
+    cum_planned_budget = fields.Monetary(string="VP Cumulé", currency_field='currency_id', readonly=True)
+    cum_earned_amount = fields.Monetary(string="VA Cumulé", currency_field='currency_id', readonly=True)
+    cum_actual_cost = fields.Monetary(string="CR Cumulé", currency_field='currency_id', readonly=True)
+    cost_performance_index = fields.Float(string="IPC", digits=(16, 4), readonly=True)
+    delay_performance_index = fields.Float(string="IPD", digits=(16, 4), readonly=True)
+    axis_data = fields.Json(string="Axes", readonly=True,
+                            help="{axe: [VP cumulé, VA cumulé, CR cumulé, IPC, IPD]}")
+
+    _sql_constraints = [
+        ('project_month_uniq', 'UNIQUE(project_financial_id, month_date)',
+         'Ce mois est déjà clôturé pour ce projet'),
+    ]
+
+    def write(self, vals):
+        raise UserError(_("Une clôture mensuelle ne peut pas être modifiée"))
+
+    def unlink(self):
+        raise UserError(_("Une clôture mensuelle ne peut pas être supprimée"))
+
+    @api.model
+    def _freeze_month(self, month_date=None, project_ids=None):
+        """
+        Fige les cumuls KPI de tous les axes au mois donné, en une insertion
+        Par défaut le mois précédent ; un mois déjà clôturé n'est pas réécrit
+        Retourne le nombre de projets clôturés
+        """
+        month_date = fields.Date.start_of(
+            month_date or fields.Date.subtract(fields.Date.today(), months=1), 'month')
+        
+        self.env.flush_all()
+        query = """
+            INSERT INTO project_financial_kpi_snapshot
+                (project_financial_id, month_date,
+                 cum_planned_budget, cum_earned_amount, cum_actual_cost,
+                 cost_performance_index, delay_performance_index, axis_data,
+                 create_uid, create_date, write_uid, write_date)
+            SELECT kpi.project_financial_id, kpi.month_date,
+                   SUM(kpi.cum_planned_budget), SUM(kpi.cum_earned_amount), SUM(kpi.cum_actual_cost),
+                   COALESCE(SUM(kpi.cum_earned_amount) / NULLIF(SUM(kpi.cum_actual_cost), 0), 0),
+                   COALESCE(SUM(kpi.cum_earned_amount) / NULLIF(SUM(kpi.cum_planned_budget), 0), 0),
+                   jsonb_object_agg(kpi.axis_id, jsonb_build_array(
+                       kpi.cum_planned_budget, kpi.cum_earned_amount, kpi.cum_actual_cost,
+                       kpi.cost_performance_index, kpi.delay_performance_index)),
+                   %s, now() at time zone 'UTC', %s, now() at time zone 'UTC'
+            FROM project_financial_axis_kpi kpi
+            WHERE kpi.month_date = %s
+              AND kpi.project_financial_id IS NOT NULL
+        """
+        params = [self.env.uid, self.env.uid, month_date]
+        if project_ids:
+            query += " AND kpi.project_financial_id IN %s"
+            params.append(tuple(project_ids))
+        query += """
+            GROUP BY kpi.project_financial_id, kpi.month_date
+            ON CONFLICT (project_financial_id, month_date) DO NOTHING
+        """
+        self.env.cr.execute(query, params)
+        count = self.env.cr.rowcount
+        _logger.info(f"Clôture KPI {month_date:%Y-%m}: {count} projets figés")
+        return count
+
+    @api.model
+    def _cron_freeze_month(self):
+        """
+        Clôture du mois précédent ; les cumuls sont à jour, chaque transaction
+        les recalculant avant son commit
+        """
+        self._freeze_month()
@@ -0,0 +1,114 @@
+import logging
+from odoo import api, fields, models
+from collections import defaultdict
+
+_logger = logging.getLogger(__name__)
+
+
+class ProjectFinancialSyncQueue(models.Model):
+    """
+    File des cellules (projet, date) à resynchroniser en différé
+    Alimentée par les opérations en masse (imports, rapprochements)
+    et par les articles dont le prix d'achat est à rafraîchir,
+    vidée par la tâche planifiée
+    """
+    _name = "project.financial.sync.queue"
+    _description = "File de synchronisation différée des axes"
+    _order = "id"
+
+    project_id = fields.Many2one('project.project', string="Projet", ondelete='cascade')
+    date = fields.Date(string="Date")
+    product_id = fields.Many2one('product.product', string="Article", ondelete='cascade')
+    source = fields.Selection([
+            ('invoice', 'Facture Fournisseur'),
+            ('mrp', 'Consommation MRP'),
+            ('price', 'Prix d\'achat'),
+        ],
+        string="Source", required=True)
+
+    _sql_constraints = [
+        ('project_date_source_uniq', 'UNIQUE(project_id, date, source)',
+         'Cette cellule est déjà en attente de synchronisation'),
+        ('product_source_uniq', 'UNIQUE(product_id, source)',
+         'Cet article est déjà en attente de synchronisation'),
+    ]
+
+    @api.model
+    def _enqueue(self, source, keys):
+        """Ajoute des couples (projet, date) à la file, sans doublon"""
+        if not keys:
+            return
+        self.env.cr.execute(f"""
+            INSERT INTO project_financial_sync_queue
+                (project_id, date, source, create_uid, create_date, write_uid, write_date)
+            VALUES {', '.join(['%s'] * len(keys))}
+            ON CONFLICT (project_id, date, source) DO NOTHING
+        """, [
+            (project_id, date, source, self.env.uid, fields.Datetime.now(), self.env.uid, fields.Datetime.now())
+            for project_id, date in keys
+        ])
+
+    @api.model
+    def _enqueue_products(self, source, product_ids):
+        """Ajoute des articles à la file, sans doublon"""
+        if not product_ids:
+            return
+        self.env.cr.execute(f"""
+            INSERT INTO project_financial_sync_queue
+                (product_id, source, create_uid, create_date, write_uid, write_date)
+            VALUES {', '.join(['%s'] * len(product_ids))}
+            ON CONFLICT (product_id, source) DO NOTHING
+        """, [
+            (product_id, source, self.env.uid, fields.Datetime.now(), self.env.uid, fields.Datetime.now())
+            for product_id in product_ids
+        ])
+
+    @api.model
+    def _cron_process_queue(self, limit=5000):
+        """Vide la file : un recalcul groupé par source"""
+        entries = self.search([], limit=limit)
+        if not entries:
+            return
+        
+        keys_by_source = defaultdict(set)
+        for entry in entries:
+            if entry.product_id:
+                keys_by_source[entry.source].add(entry.product_id.id)
+            else:
+                keys_by_source[entry.source].add((entry.project_id.id, entry.date))
+        
+        # Les prix passent en premier : ils marquent des cellules MRP à recalculer
+        for source in sorted(keys_by_source, key=lambda s: s != 'price'):
+            self._process_source(source, keys_by_source[source])
+        
+        entries.unlink()
+        _logger.info(f"File de synchronisation: {len(entries)} cellules traitées")
+        
+        if len(entries) == limit:
+            self.env.ref('somachame_finance.ir_cron_process_sync_queue')._trigger()
+
+    @api.model
+    def _process_source(self, source, keys):
+        if source == 'invoice':
+            self.env['account.move']._recompute_invoice_axis_cells(keys)
+        elif source == 'mrp':
+            self.env['stock.move']._recompute_mrp_axis_cells(keys)
+        elif source == 'price':
+            self._process_product_prices(keys)
+
+    @api.model
+    def _process_product_prices(self, product_ids):
+        """
+        Rafraîchit le prix standard des articles depuis leur dernier achat
+        et marque les cellules MRP valorisées au prix standard à recalculer
+        """
+        result = self.env['product.template'].update_prices_from_purchase_orders(product_ids)
+        changed_ids = result['changed_product_ids']
+        if not changed_ids:
+            return
+        
+        keys = self.env['stock.move']._get_mrp_standard_price_keys(changed_ids)
+        self._enqueue('mrp', keys)
+        _logger.info(f"Prix d'achat: {len(changed_ids)} articles modifiés, {len(keys)} cellules MRP à recalculer")
+        if keys:
+            self.env.ref('somachame_finance.ir_cron_process_sync_queue')._trigger()
@@ -0,0 +1,23 @@
+import logging
+from odoo import models
+
+_logger = logging.getLogger(__name__)
+
+
+class PurchaseOrder(models.Model):
+    _inherit = 'purchase.order'
+
+    def button_approve(self, force=False):
+        """
+        Surcharge de l'approbation des commandes
+        Les articles commandés sont mis en file pour rafraîchir leur prix standard
+        """
+        result = super().button_approve(force=force)
+        
+        product_ids = self.filtered(lambda o: o.state == 'purchase').order_line.product_id.ids
+        if product_ids:
+            self.env['project.financial.sync.queue']._enqueue_products('price', product_ids)
+            self.env.ref('somachame_finance.ir_cron_process_sync_queue')._trigger()
+            _logger.info(f"Commandes {self.ids}: {len(product_ids)} articles en attente de mise à jour du prix")
+        
+        return result
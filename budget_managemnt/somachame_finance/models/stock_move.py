@@ -1,13 +1,22 @@
+import json
 import logging
+import time
 from odoo import models, api, fields, _
 from odoo.exceptions import UserError
+from odoo.tools import config, split_every
 from collections import defaultdict
 
 _logger = logging.getLogger(__name__)
 
+RESYNC_STATE_PARAM = 'somachame_finance.axis_resync_state'
+
 class StockMove(models.Model):
     _inherit = 'stock.move'
 
+    axis_cost = fields.Float(string="Coût imputé aux axes", readonly=True, copy=False,
+                             help="Coût du mouvement (prix du mouvement ou coût standard) imputé aux axes MRP, "
+                                  "repris tel quel à la déconstruction")
+
     def _sync_production_axes(self):
         """Synchro des mouvements de production"""
         # 1. Synchro des composants (mouvements entrants)
@@ -20,26 +29,28 @@ class StockMove(models.Model):
                     except Exception as e:
                         _logger.error(f"Erreur synchro composant {move.id}: {str(e)}")
         
-        # 2. Synchro du produit fini (mouvement sortant) pour taux d'avancement
+        # 2. Synchro du produit fini (mouvement sortant)
+        # Les axes 'Taux d'Avancement' sont recalculés en lot par MrpProduction._sync_rate_axes
         for move in self.move_finished_ids:
             if move._is_valid_for_axis_sync():
-                axes = move._get_financial_axes()
+                axes = move._get_financial_axes().filtered(lambda a: a.type != 'rate')
                 for axis in axes:
                     try:
-                        if axis.type == 'rate':
-                            move._update_axis_line_for_rate(axis, self)
-                        else:
-                            move._update_axis_line_cost(axis)
+                        move._update_axis_line_cost(axis)
                     except Exception as e:
                         _logger.error(f"Erreur synchro produit fini {move.id}: {str(e)}")
     
-    def _get_product_cost_for_axis(self):
+    def _get_product_cost_for_axis(self, axis=False):
         """
         Version simplifiée - utilise directement price_unit d'Odoo
+        Si l'axe est valorisé par les couches de stock, utilise leur valeur
         """
         if not self.product_id or self.product_qty <= 0:
             return 0.0
         
+        if axis and axis.mrp_cost_source == 'valuation' and self.stock_valuation_layer_ids:
+            return -sum(self.stock_valuation_layer_ids.mapped('value'))
+        
         # price_unit est déjà calculé par Odoo selon la méthode de coût
         cost_per_unit = abs(self.price_unit) if self.price_unit else 0.0
         
@@ -49,6 +60,186 @@ class StockMove(models.Model):
         
         return self.product_qty * cost_per_unit
 
+    @api.model
+    def _read_mrp_valuation_costs(self, account_ids, production_ids=None):
+        """
+        Agrège stock.valuation.layer.value des consommations de débitage
+        Retourne {(compte analytique, date de production, catégorie produit): coût}
+        """
+        if not account_ids:
+            return {}
+        
+        self.env.flush_all()
+        query = """
+            SELECT sm.analytic_account_id,
+                   mp.date_finished::date,
+                   pt.categ_id,
+                   SUM(-svl.value)
+            FROM stock_valuation_layer svl
+            JOIN stock_move sm ON sm.id = svl.stock_move_id
+            JOIN mrp_production mp ON mp.id = sm.raw_material_production_id
+            JOIN stock_location loc ON loc.id = sm.location_dest_id
+            JOIN product_product pp ON pp.id = sm.product_id
+            JOIN product_template pt ON pt.id = pp.product_tmpl_id
+            WHERE sm.state = 'done'
+              AND mp.state = 'done'
+              AND mp.type_operation = 'debitage'
+              AND loc.usage = 'production'
+              AND sm.analytic_account_id IN %s
+        """
+        params = [tuple(account_ids)]
+        if production_ids:
+            query += " AND mp.id IN %s"
+            params.append(tuple(production_ids))
+        query += " GROUP BY sm.analytic_account_id, mp.date_finished::date, pt.categ_id"
+        
+        self.env.cr.execute(query, params)
+        return {(account_id, date, categ_id): value
+                for account_id, date, categ_id, value in self.env.cr.fetchall()}
+
+    @api.model
+    def _get_valuation_costs_for_axes(self, axes, production_ids=None):
+        """
+        Coûts MRP des axes valorisés par les couches de stock
+        Retourne {axis_id: {date_str: coût}}
+        """
+        axis_costs = defaultdict(lambda: defaultdict(float))
+        axes = axes.filtered(lambda a: a.cost_type == 'mrp' and a.mrp_cost_source == 'valuation')
+        if not axes:
+            return axis_costs
+        
+        costs = self._read_mrp_valuation_costs(axes.mapped('analytic_account_id').ids, production_ids)
+        categ_ids = {categ_id for _account_id, _date, categ_id in costs}
+        categ_axis_maps = {
+            account.id: axes.filtered(lambda a: a.analytic_account_id == account)._get_category_axis_map(categ_ids)
+            for account in axes.mapped('analytic_account_id')
+        }
+        
+        for (account_id, date, categ_id), value in costs.items():
+            for axis in categ_axis_maps[account_id].get(categ_id, []):
+                axis_costs[axis.id][date.strftime('%Y-%m-%d')] += value
+        
+        _logger.info(f"Coûts valorisation MRP: {len(costs)} agrégats pour {len(axes)} axes")
+        return axis_costs
+
+    @api.model
+    def _get_mrp_standard_price_keys(self, product_ids):
+        """
+        Couples (projet, date) des consommations de débitage valorisées
+        au prix standard (price_unit nul) de ces articles
+        """
+        if not product_ids:
+            return set()
+        
+        self.env.flush_all()
+        self.env.cr.execute("""
+            SELECT DISTINCT pfp.project_id, mp.date_finished::date
+            FROM stock_move sm
+            JOIN mrp_production mp ON mp.id = sm.raw_material_production_id
+            JOIN stock_location loc ON loc.id = sm.location_dest_id
+            JOIN project_financial_progress pfp ON pfp.account_id = sm.analytic_account_id
+            WHERE sm.product_id IN %s
+              AND COALESCE(sm.price_unit, 0) = 0
+              AND sm.state = 'done'
+              AND sm.product_qty > 0
+              AND mp.state = 'done'
+              AND mp.type_operation = 'debitage'
+              AND loc.usage = 'production'
+        """, [tuple(product_ids)])
+        return set(self.env.cr.fetchall())
+
+    @api.model
+    def _recompute_mrp_axis_cells(self, keys):
+        """
+        Recalcule le coût MRP des cellules (axe, date) des couples (projet, date)
+        depuis toutes les consommations de débitage, puis un seul upsert
+        La part déconstruite de chaque OF est exclue, comme l'a retirée
+        _prepare_axes_cleanup ; le coût imputé des mouvements est mis à jour
+        pour les déconstructions futures
+        """
+        dates_by_project = defaultdict(set)
+        for project_id, date in keys:
+            dates_by_project[project_id].add(date)
+        
+        self.env.flush_all()
+        AxisLine = self.env['project.financial.axis.line']
+        cells = {}
+        for project_id, dates in dates_by_project.items():
+            axes = self.env['project.financial.axis'].search([
+                ('project_financial_id.project_id', '=', project_id),
+                ('cost_type', '=', 'mrp'),
+            ])
+            if not axes:
+                continue
+            
+            self.env.cr.execute("""
+                SELECT sm.id, mp.id, sm.product_id, mp.company_id, pt.categ_id, mp.date_finished::date,
+                       sm.product_qty, ABS(COALESCE(sm.price_unit, 0)),
+                       COALESCE(layer.value, 0), layer.count > 0
+                FROM stock_move sm
+                JOIN mrp_production mp ON mp.id = sm.raw_material_production_id
+                JOIN stock_location loc ON loc.id = sm.location_dest_id
+                JOIN product_product pp ON pp.id = sm.product_id
+                JOIN product_template pt ON pt.id = pp.product_tmpl_id
+                JOIN project_financial_progress pfp ON pfp.account_id = sm.analytic_account_id
+                LEFT JOIN LATERAL (
+                    SELECT SUM(-svl.value) AS value, COUNT(*) AS count
+                    FROM stock_valuation_layer svl
+                    WHERE svl.stock_move_id = sm.id
+                ) layer ON TRUE
+                WHERE pfp.project_id = %s
+                  AND mp.date_finished::date IN %s
+                  AND sm.state = 'done'
+                  AND sm.product_qty > 0
+                  AND mp.state = 'done'
+                  AND mp.type_operation = 'debitage'
+                  AND loc.usage = 'production'
+            """, [project_id, tuple(dates)])
+            rows = self.env.cr.fetchall()
+            
+            # Prix standard par société, lu une fois par article
+            standard_prices = {}
+            for company_id in {row[3] for row in rows}:
+                products = self.env['product.product'].with_company(company_id).browse(
+                    {row[2] for row in rows if row[3] == company_id and not row[7]}
+                )
+                standard_prices.update({(product.id, company_id): product.standard_price for product in products})
+            
+            remaining = self.env['mrp.production'].browse({row[1] for row in rows})._get_remaining_ratios()
+            categ_axis_map = axes._get_category_axis_map({row[4] for row in rows})
+            project_cells = defaultdict(float)
+            move_costs = []
+            for move_id, production_id, product_id, company_id, categ_id, date, qty, price_unit, layer_value, has_layer in rows:
+                move_cost = qty * (price_unit or standard_prices[(product_id, company_id)])
+                move_costs.append((move_id, move_cost))
+                for axis in categ_axis_map.get(categ_id, []):
+                    cost = layer_value if axis.mrp_cost_source == 'valuation' and has_layer else move_cost
+                    project_cells[(axis.id, date)] += cost * remaining[production_id]
+            self._store_axis_costs(move_costs)
+            
+            # Les cellules existantes sans consommation correspondante reviennent à 0
+            for line in AxisLine.search([
+                ('axis_id', 'in', axes.ids),
+                ('date', 'in', list(dates)),
+            ]):
+                project_cells.setdefault((line.axis_id.id, line.date), 0.0)
+            cells.update({key: {'actual_cost': cost} for key, cost in project_cells.items()})
+        
+        _logger.info(f"MRP: {len(cells)} cellules recalculées pour {len(dates_by_project)} projet(s)")
+        return AxisLine._upsert_cells(cells, ['actual_cost'])
+
+    @api.model
+    def _store_axis_costs(self, move_costs):
+        """Enregistre en masse le coût imputé des mouvements [(move_id, coût)]"""
+        for chunk in split_every(1000, move_costs):
+            self.env.cr.execute(f"""
+                UPDATE stock_move sm
+                SET axis_cost = v.cost
+                FROM (VALUES {', '.join(['%s'] * len(chunk))}) AS v(id, cost)
+                WHERE sm.id = v.id
+            """, chunk)
+        self.browse([move_id for move_id, _cost in move_costs]).invalidate_recordset(['axis_cost'])
+
     def _calculate_earned_value_for_axis(self, axis):
         """
         Calcule la valeur acquise selon l'unité de l'axe
@@ -378,8 +569,8 @@ class StockMove(models.Model):
         total = 0.0
         domain = self._get_axis_calculation_domain(axis)
         axis_line = AxisLine.search([('axis_id', '=', axis.id), ('date', '=', date)], limit=1)
-        moves = self.env['stock.move'].search(domain).filtred(
-            lambda move: date == move.__get_move_date_for_axis()
+        moves = self.env['stock.move'].search(domain).filtered(
+            lambda move: date == move._get_move_date_for_axis()
             )
         
         _logger.info(f"Calcul axe {axis.complete_name} - {len(moves)} mouvements trouvés")
@@ -412,9 +603,12 @@ class StockMove(models.Model):
         
         _logger.info(f"Calcul axe {axis.complete_name} - {len(moves)} mouvements trouvés")
         
-        cost = self._get_product_cost_for_axis()
+        cost = self._get_product_cost_for_axis(axis)
         # self.product_qty * self.product_id.standard_price
         _logger.info(f"le coùt est : {cost}")
+        if not self.axis_cost:
+            # Coût retenu à l'imputation, soustrait tel quel en cas de déconstruction
+            self.axis_cost = self._get_product_cost_for_axis()
         if axis_line:
             old = axis_line.actual_cost
             axis_line.write({'actual_cost': old + cost})
@@ -513,64 +707,113 @@ class StockMove(models.Model):
     # ===== MÉTHODES UTILITAIRES =====
 
     def action_resync_all_axes(self):
-        """Recalcule tous les axes pour les mouvements"""
-        _logger.info("=== Début resynchronisation complète des axes ===")
-        
-        # Trouver tous les mouvements valides
-        domain = [
-            ('state', '=', 'done'),
-            ('product_qty', '>', 0),
-        ]
-        
-        # Différents types de mouvements
-        movement_types = [
-            ('picking_id', '!=', False),
-            ('raw_material_production_id', '!=', False),
-            ('production_id', '!=', False),
-            ('unbuild_id', '!=', False),
-            ('consume_unbuild_id', '!=', False),
-        ]
-        
-        or_domains = []
-        for field, operator, value in movement_types:
-            or_domains.append([(field, operator, value)])
-        
-        if or_domains:
-            domain.append('|' * (len(or_domains) - 1))
-            for sub_domain in or_domains:
-                domain.extend(sub_domain)
-        
-        moves = self.search(domain)
-        _logger.info(f"{len(moves)} mouvements à resynchroniser")
-        
-        # Traiter par lots
-        batch_size = 100
-        for i in range(0, len(moves), batch_size):
-            batch = moves[i:i + batch_size]
-            for move in batch:
-                if move._is_valid_for_axis_sync():
-                    axes = move._get_financial_axes()
-                    for axis in axes:
-                        try:
-                            move._update_axis_line_total(axis)
-                        except Exception as e:
-                            _logger.error(f"Erreur resynchro mouvement {move.id}: {str(e)}")
-            
-            _logger.info(f"Traité lot {i//batch_size + 1}/{(len(moves)+batch_size-1)//batch_size}")
-        
-        _logger.info("=== Fin resynchronisation ===")
+        """
+        Lance la resynchronisation complète des axes en tâche planifiée
+        Reprend depuis le dernier point de contrôle en cas d'interruption
+        """
+        state = self._get_resync_state()
+        if state.get('status') != 'running':
+            self._set_resync_state({
+                'status': 'running',
+                'last_id': 0,
+                'done': 0,
+                'total': self.search_count(self._get_resync_domain()),
+                'started_at': time.time(),
+            })
+        self.env.ref('somachame_finance.ir_cron_resync_axes')._trigger()
         
         return {
             'type': 'ir.actions.client',
             'tag': 'display_notification',
             'params': {
-                'title': _('Resynchronisation terminée'),
-                'message': _('%s mouvements resynchronisés avec les axes') % len(moves),
-                'type': 'success',
+                'title': _('Resynchronisation lancée'),
+                'message': _('La resynchronisation des axes s\'exécute en arrière-plan.'),
+                'type': 'info',
                 'sticky': False,
             }
         }
 
+    @api.model
+    def _get_resync_domain(self):
+        """Mouvements de transfert validés, recalculables de façon idempotente"""
+        return [
+            ('state', '=', 'done'),
+            ('product_qty', '>', 0),
+            ('picking_id', '!=', False),
+        ]
+
+    @api.model
+    def _get_resync_state(self):
+        value = self.env['ir.config_parameter'].sudo().get_param(RESYNC_STATE_PARAM)
+        return json.loads(value) if value else {}
+
+    @api.model
+    def _set_resync_state(self, state):
+        self.env['ir.config_parameter'].sudo().set_param(RESYNC_STATE_PARAM, json.dumps(state))
+
+    @api.model
+    def _get_resync_time_budget(self):
+        """Durée d'exécution autorisée, sous la limite du worker cron"""
+        limit = config.get('limit_time_real_cron') or -1
+        if limit <= 0:
+            limit = config.get('limit_time_real') or 600
+        return limit * 0.8
+
+    @api.model
+    def _cron_resync_axes(self, chunk_size=500):
+        """
+        Resynchronisation par lots avec curseur sur l'id
+        Chaque lot est validé (commit) avec son point de contrôle ;
+        la tâche se replanifie avant d'atteindre la limite du worker
+        """
+        state = self._get_resync_state()
+        if state.get('status') != 'running':
+            return
+        
+        start = time.time()
+        budget = self._get_resync_time_budget()
+        domain = self._get_resync_domain()
+        
+        while True:
+            moves = self.search(domain + [('id', '>', state['last_id'])], order='id', limit=chunk_size)
+            if not moves:
+                state['status'] = 'done'
+                self._set_resync_state(state)
+                _logger.info(f"=== Fin resynchronisation: {state['done']} mouvements ===")
+                return
+            
+            # Une seule mise à jour par (axe, date) pour tout le lot
+            cells = {}
+            for move in moves:
+                if not move._is_valid_for_axis_sync():
+                    continue
+                for axis in move._get_financial_axes():
+                    cells.setdefault((axis.id, move._get_move_date_for_axis()), (move, axis))
+            
+            for move, axis in cells.values():
+                try:
+                    move._update_axis_line_total(axis)
+                except Exception as e:
+                    _logger.error(f"Erreur resynchro mouvement {move.id}: {str(e)}")
+            
+            state['last_id'] = moves[-1].id
+            state['done'] += len(moves)
+            self._set_resync_state(state)
+            self.env.cr.commit()
+            
+            elapsed = time.time() - state['started_at']
+            rate = state['done'] / elapsed if elapsed else 0.0
+            remaining = max(state['total'] - state['done'], 0)
+            eta = remaining / rate if rate else 0.0
+            _logger.info(f"Resynchro: {state['done']}/{state['total']} mouvements, "
+                         f"{rate:.1f} mvt/s, reste ~{eta:.0f}s")
+            self.env['ir.cron']._notify_progress(done=len(moves), remaining=remaining)
+            
+            if time.time() - start > budget:
+                _logger.info("Resynchro: limite de temps atteinte, replanification")
+                self.env.ref('somachame_finance.ir_cron_resync_axes')._trigger()
+                return
+
     def returning_exception(self, type):
         """Gestion des exceptions"""
         error_message = _(
@@ -1,6 +1,8 @@
 import logging
 from odoo import models, api, fields, _
 from odoo.exceptions import UserError
+from odoo.tools import split_every
+from collections import defaultdict
 
 _logger = logging.getLogger(__name__)
 
@@ -94,47 +96,82 @@ class ProductTemplate(models.Model):
     _inherit = 'product.template'
     
     @api.model
-    def update_prices_from_purchase_orders(self):
+    def _read_latest_purchase_prices(self, product_ids=None):
+        """
+        Dernier prix d'achat confirmé par (article, société), en une requête
+        product_ids: limite la lecture à ces articles
+        Retourne [(product_id, company_id, price_unit)]
+        """
+        self.env.flush_all()
+        query = """
+            SELECT DISTINCT ON (pol.product_id, po.company_id)
+                   pol.product_id, po.company_id, pol.price_unit
+            FROM purchase_order_line pol
+            JOIN purchase_order po ON po.id = pol.order_id
+            WHERE po.state = 'purchase'
+              AND pol.product_id IS NOT NULL
+        """
+        params = []
+        if product_ids:
+            query += " AND pol.product_id IN %s"
+            params.append(tuple(product_ids))
+        query += " ORDER BY pol.product_id, po.company_id, po.date_order DESC, pol.id DESC"
+        self.env.cr.execute(query, params)
+        return self.env.cr.fetchall()
+    
+    @api.model
+    def update_prices_from_purchase_orders(self, product_ids=None):
         """
         Update standard_price from latest confirmed purchase order prices
+        Seuls les prix modifiés sont écrits, en une écriture par (société, prix)
+        product_ids: limite la mise à jour à ces articles
         """
         ProductProduct = self.env['product.product']
+        rows = self._read_latest_purchase_prices(product_ids)
         
-        # Search for all confirmed purchase order lines
-        pol_lines = self.env['purchase.order.line'].search([
-            ('order_id.state', '=', 'purchase'),
-            ('product_id', '!=', False)
-        ], order='order_id.date_order desc, id desc')
-        
-        # Dictionary to store latest price per product
-        product_latest_prices = {}
+        prices_by_company = defaultdict(dict)
+        for product_id, company_id, price_unit in rows:
+            prices_by_company[company_id][product_id] = price_unit
         
-        # Get latest price for each product
-        for line in pol_lines:
-            product_id = line.product_id.id
-            if product_id not in product_latest_prices:
-                product_latest_prices[product_id] = line.price_unit
+        changed_ids = set()
+        skipped_count = 0
+        for company_id, prices in prices_by_company.items():
+            company = self.env['res.company'].browse(company_id)
+            for batch_ids in split_every(1000, list(prices)):
+                products = ProductProduct.with_company(company).browse(batch_ids).exists()
+                skipped_count += len(batch_ids) - len(products)
+                
+                # Regroupement des articles à mettre au même prix
+                to_write = defaultdict(list)
+                for product in products:
+                    latest_price = prices[product.id]
+                    if product.currency_id.compare_amounts(product.standard_price, latest_price) == 0:
+                        skipped_count += 1
+                        continue
+                    to_write[latest_price].append(product.id)
+                
+                for latest_price, product_ids in to_write.items():
+                    try:
+                        with self.env.cr.savepoint():
+                            ProductProduct.with_company(company).browse(product_ids).write({
+                                'standard_price': latest_price,
+                            })
+                        changed_ids.update(product_ids)
+                    except Exception as e:
+                        skipped_count += len(product_ids)
+                        _logger.error(f"Error updating products {product_ids} ({company.name}): {e}")
+                
+                products.invalidate_recordset()
         
-        # Update product standard prices
-        updated_count = 0
-        for product_id, latest_price in product_latest_prices.items():
-            try:
-                product = ProductProduct.browse(product_id)
-                if product.exists() and product.standard_price != latest_price:
-                    # Update the product template's standard_price
-                    product.product_tmpl_id.write({'standard_price': latest_price})
-                    _logger.info(
-                        f"Updated {product.default_code or product.name}: "
-                        f"{product.standard_price} → {latest_price}"
-                    )
-                    updated_count += 1
-            except Exception as e:
-                _logger.error(f"Error updating product {product_id}: {e}")
-        
-        _logger.info(f"Price update completed: {updated_count} products updated")
+        _logger.info(
+            f"Price update completed: {len(rows)} scanned, "
+            f"{len(changed_ids)} products updated, {skipped_count} skipped"
+        )
         return {
-            'updated_count': updated_count,
-            'total_products': len(product_latest_prices)
+            'updated_count': len(changed_ids),
+            'changed_product_ids': list(changed_ids),
+            'skipped_count': skipped_count,
+            'total_products': len(rows),
         }
     
     def cron_update_prices_from_purchase(self):